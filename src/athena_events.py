@@ -1,17 +1,44 @@
+import concurrent.futures
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import json
 import logging
+import math
 import os
+import re
 import time
+from collections import deque
+from datetime import date, datetime, timezone
+from decimal import Decimal
 from enum import Enum
 from pathlib import Path
-from typing import Generator, List, Dict
 
-import boto3
+from typing import Generator, List, Dict, Tuple, Callable, Any, Set
 
 from common_utils import (
+    create_client,
     get_day_back,
     get_yesterday,
     get_days,
     clear_folder,
+    get_history_format,
+    iter_s3_lines,
+    split_s3_path,
+    obj_exists,
+    list_objects,
+    list_keys,
+    delete_objects,
+    S3ParquetWriter,
+    get_run_id,
+    get_run_prefix,
+    fan_out,
+    complete_unit,
+    release_unit,
+    get_telemetry,
+    metrics,
 )
 
 logger = logging.getLogger()
@@ -42,10 +69,40 @@ def get_regions() -> List[str]:
     return os.environ.get("REGIONS", os.environ["AWS_REGION"]).split(",")
 
 
+def get_partition_projection() -> bool:
+    return os.environ.get("PARTITION_PROJECTION", "false").lower() == "true"
+
+
+def get_projection_start_day() -> str:
+    return os.environ.get("PROJECTION_START_DAY", "2020-01-01")
+
+
+def get_results_from_s3() -> bool:
+    return os.environ.get("RESULTS_FROM_S3", "true").lower() == "true"
+
+
+def get_query_cache_max_age() -> int:
+    return int(os.environ.get("QUERY_CACHE_MAX_AGE_MINUTES", "0"))
+
+
+def get_query_cache_max_entries() -> int:
+    return int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "1000"))
+
+
+def get_compaction_target_size() -> int:
+    return int(os.environ.get("COMPACTION_TARGET_FILE_MB", "256")) * 1024 * 1024
+
+
+def get_max_concurrent_queries() -> int:
+    # Should not exceed the active DML queries quota of the account / workgroup
+    return int(os.environ.get("MAX_CONCURRENT_QUERIES", "20"))
+
+
 class TableType(Enum):
     CLOUD_TRAIL = (0,)
     HISTORY = (1,)
     EVENTS = (2,)
+    CLOUD_TRAIL_ATHENA = (3,)
 
     @property
     def table_name(self):
@@ -64,88 +121,447 @@ class TableType(Enum):
         )
 
 
-def run_query(query: str):
-    client = boto3.client("athena")
-    response = client.start_query_execution(
-        QueryString=query,
-        ResultConfiguration={
+def get_cloud_trail_extract() -> bool:
+    return os.environ.get("CLOUD_TRAIL_EXTRACT", "false").lower() == "true"
+
+
+def get_extract_workers() -> int:
+    return int(os.environ.get("EXTRACT_WORKERS", "16"))
+
+
+def get_events_sort_by() -> List[str]:
+    # Columns the events are laid out by, e.g. user_identity_arn,workgroup. Athena
+    # buckets the files by the first column, which only guarantees that a principal is
+    # in one file, Athena does not keep an order within the buckets. The local engine
+    # sorts by all the columns, its row group min/max statistics let Athena skip the
+    # row groups of other principals
+    columns = [c.strip() for c in os.environ.get("EVENTS_SORT_BY", "").split(",")]
+    columns = [c for c in columns if c]
+    for column in columns:
+        if column not in EVENTS_COLUMNS:
+            raise ValueError(f"Unsupported events sort column: {column}")
+    return columns
+
+
+def get_events_bucket_count() -> int:
+    # Files per sorted events partition, a principal's events are all in one of them
+    return int(os.environ.get("EVENTS_BUCKET_COUNT", "8"))
+
+
+def get_events_row_group_size() -> int:
+    # Smaller than the history row groups, so the min/max statistics of sorted events
+    # files cover few principals each
+    return int(os.environ.get("EVENTS_ROW_GROUP_SIZE", "10000"))
+
+
+def get_local_join_max_memory_bytes() -> int:
+    # The history index and the sort buffer each hold up to this much before spilling to
+    # local storage, by default a quarter of the function memory
+    memory_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+    max_mb = float(os.environ.get("LOCAL_JOIN_MAX_MEMORY_MB", str(memory_mb // 4)))
+    return int(max_mb * 1024 * 1024)
+
+
+def get_record_size(*values: Any) -> int:
+    # Estimated memory of a held record, its strings and a fixed per object overhead
+    return sum(len(v) for v in values if isinstance(v, str)) + 64 * len(values)
+
+
+def get_table_types() -> List[TableType]:
+    # The Athena-only CloudTrail extract table exists only when the extract is used
+    return [
+        t
+        for t in TableType
+        if t != TableType.CLOUD_TRAIL_ATHENA or get_cloud_trail_extract()
+    ]
+
+
+def get_source_table_types(engine: str = "athena") -> List[TableType]:
+    # The tables whose partitions are added before the events are produced. The local
+    # engine reads the objects directly, only the events partition it writes has to be
+    # added. The same goes for the CTAS of sorted events, unlike an INSERT INTO
+    if engine == "local":
+        return [TableType.EVENTS]
+    if get_cloud_trail_extract():
+        table_types = [TableType.HISTORY, TableType.CLOUD_TRAIL_ATHENA]
+    else:
+        table_types = [TableType.HISTORY, TableType.CLOUD_TRAIL]
+    if get_events_sort_by():
+        table_types.append(TableType.EVENTS)
+    return table_types
+
+
+def get_query_poll_interval() -> float:
+    return float(os.environ.get("QUERY_POLL_INTERVAL", "0.1"))
+
+
+def get_query_poll_max_interval() -> float:
+    return float(os.environ.get("QUERY_POLL_MAX_INTERVAL", "5"))
+
+
+def start_query(client, query: str, result_reuse_minutes: int = 0) -> str:
+    params = {
+        "QueryString": query,
+        "ResultConfiguration": {
             "OutputLocation": f"s3://{get_athena_output_bucket()}/{get_athena_output_folder()}"
         },
-        WorkGroup=get_workgroup(),
+        "WorkGroup": get_workgroup(),
+    }
+    if result_reuse_minutes > 0:
+        params["ResultReuseConfiguration"] = {
+            "ResultReuseByAgeConfiguration": {
+                "Enabled": True,
+                "MaxAgeInMinutes": result_reuse_minutes,
+            }
+        }
+    try:
+        response = client.start_query_execution(**params)
+    except client.exceptions.ClientError as e:
+        # Result reuse requires Athena engine version 3
+        if "ResultReuseConfiguration" not in params or (
+            e.response["Error"]["Code"] != "InvalidRequestException"
+        ):
+            raise e
+        del params["ResultReuseConfiguration"]
+        response = client.start_query_execution(**params)
+    return response["QueryExecutionId"]
+
+
+def get_query_executions_data(client, ids: List[str]) -> dict:
+    return client.batch_get_query_execution(QueryExecutionIds=ids)
+
+
+def get_execution_result(query_execution: dict) -> dict:
+    result = {"execution_id": query_execution["QueryExecutionId"]}
+    status = query_execution["Status"]["State"]
+    result["status"] = status
+    if status == "SUCCEEDED":
+        result["seconds"] = query_execution["Statistics"]["EngineExecutionTimeInMillis"]
+        result["data_scanned_mb"] = (
+            int(query_execution["Statistics"]["DataScannedInBytes"]) / 1024.0 / 1024.0
+        )
+    if "StateChangeReason" in query_execution["Status"]:
+        result["error"] = query_execution["Status"]["StateChangeReason"]
+    if "OutputLocation" in query_execution.get("ResultConfiguration", {}):
+        result["output_location"] = query_execution["ResultConfiguration"][
+            "OutputLocation"
+        ]
+    return result
+
+
+def record_query_metrics(query_execution: dict, wall_seconds: float):
+    statistics = query_execution.get("Statistics", {})
+    metrics.record(
+        "athena.query",
+        wall_ms=wall_seconds * 1000,
+        queue_ms=statistics.get("QueryQueueTimeInMillis", 0),
+        engine_ms=statistics.get("EngineExecutionTimeInMillis", 0),
+        scanned_bytes=statistics.get("DataScannedInBytes", 0),
+        failed=int(query_execution["Status"]["State"] != "SUCCEEDED"),
+    )
+
+
+def run_queries(
+    queries: List[str], result_reuse_minutes: int = 0
+) -> Generator[Tuple[int, dict], None, None]:
+    # Starts up to MAX_CONCURRENT_QUERIES queries and polls all of them with one
+    # batch_get_query_execution call per 50 ids. The poll interval starts small and
+    # backs off exponentially, results are yielded as (index, result) on completion
+    client = create_client("athena")
+    waiting = deque(enumerate(queries))
+    running = {}
+    interval = get_query_poll_interval()
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < get_max_concurrent_queries():
+            index, query = waiting.popleft()
+            execution_id = start_query(client, query, result_reuse_minutes)
+            running[execution_id] = (index, time.monotonic())
+            interval = get_query_poll_interval()
+        time.sleep(interval)
+        interval = min(interval * 2, get_query_poll_max_interval())
+        execution_ids = list(running)
+        for i in range(0, len(execution_ids), 50):
+            response = get_query_executions_data(client, execution_ids[i : i + 50])
+            for query_execution in response["QueryExecutions"]:
+                if query_execution["Status"]["State"] in [
+                    "FAILED",
+                    "CANCELLED",
+                    "SUCCEEDED",
+                ]:
+                    index, started = running.pop(query_execution["QueryExecutionId"])
+                    record_query_metrics(query_execution, time.monotonic() - started)
+                    yield index, get_execution_result(query_execution)
+        for execution_id, (index, started) in list(running.items()):
+            if time.monotonic() - started > get_query_timeout():
+                err_msg = f"Timeout of {get_query_timeout()} seconds occurred. Canceling query execution. Query id: {execution_id}"
+                logger.warning(err_msg)
+                client.stop_query_execution(QueryExecutionId=execution_id)
+                del running[execution_id]
+                yield index, {"execution_id": execution_id, "error": err_msg}
+
+
+def normalize_query(query: str) -> str:
+    # Whitespace and case are normalized outside of string literals only
+    parts = query.strip().rstrip(";").strip().split("'")
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i]).lower()
+    return "'".join(parts)
+
+
+def is_cacheable_query(query: str) -> bool:
+    # DDL and INSERT statements change data, only read statements are cached
+    first_word = normalize_query(query).lstrip("( ").split(" ", 1)[0]
+    return first_word in ["select", "with", "explain"]
+
+
+def get_query_cache_folder() -> str:
+    return f"{get_athena_output_folder()}/_cache"
+
+
+def get_query_cache_key(query: str) -> str:
+    digest = hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+    return f"{get_query_cache_folder()}/{digest}.json"
+
+
+def get_cached_result(query: str) -> dict | None:
+    s3_client = create_client("s3")
+    key = get_query_cache_key(query)
+    try:
+        response = s3_client.get_object(Bucket=get_athena_output_bucket(), Key=key)
+    except s3_client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return None
+        raise e
+    entry = json.loads(response["Body"].read())
+    age_minutes = (time.time() - entry["created"]) / 60
+    output_location = entry["result"].get("output_location")
+    if age_minutes > get_query_cache_max_age() or (
+        output_location and not obj_exists(*split_s3_path(output_location), s3_client)
+    ):
+        s3_client.delete_object(Bucket=get_athena_output_bucket(), Key=key)
+        return None
+    logger.info(f"Using cached result of execution: {entry['result']['execution_id']}")
+    return entry["result"]
+
+
+def put_cached_result(query: str, result: dict):
+    entry = {"created": time.time(), "result": result}
+    create_client("s3").put_object(
+        Bucket=get_athena_output_bucket(),
+        Key=get_query_cache_key(query),
+        Body=json.dumps(entry).encode("utf-8"),
     )
-    time.sleep(2)
-    execution_id = response["QueryExecutionId"]
-    sleep_in_interval = 10
-    intervals = int(get_query_timeout() / sleep_in_interval)
-    result = {"execution_id": execution_id}
-    for wait_index in range(intervals):
-        stats = client.get_query_execution(QueryExecutionId=execution_id)
-        status = stats["QueryExecution"]["Status"]["State"]
-        if status in ["FAILED", "CANCELLED", "SUCCEEDED"]:
-            result["status"] = status
-            if status == "SUCCEEDED":
-                result["seconds"] = stats["QueryExecution"]["Statistics"][
-                    "EngineExecutionTimeInMillis"
-                ]
-                result["data_scanned_mb"] = (
-                    int(stats["QueryExecution"]["Statistics"]["DataScannedInBytes"])
-                    / 1024.0
-                    / 1024.0
-                )
-            if "StateChangeReason" in stats["QueryExecution"]["Status"]:
-                error_message = stats["QueryExecution"]["Status"]["StateChangeReason"]
-                result["error"] = error_message
+
+
+def evict_query_cache():
+    # Removes expired entries, and the oldest entries beyond QUERY_CACHE_MAX_ENTRIES
+    s3_client = create_client("s3")
+    paginator = s3_client.get_paginator("list_objects_v2")
+    entries = []
+    for page in paginator.paginate(
+        Bucket=get_athena_output_bucket(), Prefix=f"{get_query_cache_folder()}/"
+    ):
+        entries += page.get("Contents", [])
+    entries.sort(key=lambda entry: entry["LastModified"], reverse=True)
+    expired = [
+        entry["Key"]
+        for i, entry in enumerate(entries)
+        if i >= get_query_cache_max_entries()
+        or time.time() - entry["LastModified"].timestamp()
+        > get_query_cache_max_age() * 60
+    ]
+    delete_objects(get_athena_output_bucket(), expired, s3_client)
+    if len(expired) > 0:
+        logger.info(f"Evicted {len(expired)} cached query results")
+
+
+def run_query(query: str, cache: bool = True) -> dict:
+    # Read queries are served from the result cache when QUERY_CACHE_MAX_AGE_MINUTES
+    # is set. Athena result reuse is requested too, it skips scanning the data again
+    # when the cached entry was evicted
+    max_age = get_query_cache_max_age() if cache and is_cacheable_query(query) else 0
+    if max_age > 0:
+        result = get_cached_result(query)
+        if result:
+            metrics.record("athena.query_cache_hit")
             return result
-        if wait_index % 6 == 0 and wait_index > 0:
-            logger.info("Waiting to query for %d minutes", wait_index / 6)
-        time.sleep(sleep_in_interval)
-    err_msg = f"Timeout of {get_query_timeout()} seconds occurred. Canceling query execution. Query id: {execution_id}"
-    logger.warning(err_msg)
-    result["error"] = err_msg
-    client.stop_query_execution(QueryExecutionId=execution_id)
+    result = next(run_queries([query], max_age))[1]
+    if max_age > 0 and result.get("status") == "SUCCEEDED":
+        put_cached_result(query, result)
     return result
 
 
-def get_query_results(query: str) -> Generator[Dict, None, None]:
-    result = run_query(query)
-    client = boto3.client("athena")
+COLUMN_TYPES: Dict[str, Callable[[str], Any]] = {
+    "tinyint": int,
+    "smallint": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double": float,
+    "decimal": Decimal,
+    "boolean": lambda value: value == "true",
+    "date": date.fromisoformat,
+    "timestamp": datetime.fromisoformat,
+}
+
+
+def read_csv_results(output_location: str) -> Generator[List, None, None]:
+    # Athena writes NULL as an unquoted empty field, QUOTE_NOTNULL reads it as None
+    bucket, key = split_s3_path(output_location)
+    yield from csv.reader(iter_s3_lines(bucket, key), quoting=csv.QUOTE_NOTNULL)
+
+
+def read_paginated_results(execution_id: str) -> Generator[List, None, None]:
+    client = create_client("athena")
     pages_it = client.get_paginator("get_query_results").paginate(
-        QueryExecutionId=result["execution_id"]
+        QueryExecutionId=execution_id
     )
-    columns = None
     for page in pages_it:
-        row_it = iter(page["ResultSet"]["Rows"])
-        if columns is None:
-            header = next(row_it)["Data"]
-            columns = [header[i]["VarCharValue"] for i in range(len(header))]
-        for row in row_it:
-            row_dict = {}
-            for i, col in enumerate(columns):
-                value = row["Data"][i]
-                row_dict[col] = value["VarCharValue"] if value else None
-            yield row_dict
-
-
-def insert_data(full_day_str: str, region: str):
-    year = full_day_str[:4]
-    month = full_day_str[5:7]
-    day = full_day_str[-2:]
+        for row in page["ResultSet"]["Rows"]:
+            yield [value.get("VarCharValue") for value in row["Data"]]
+
+
+def get_column_converters(execution_id: str) -> List[Callable[[str], Any]]:
+    client = create_client("athena")
+    response = client.get_query_results(QueryExecutionId=execution_id, MaxResults=1)
+    return [
+        COLUMN_TYPES.get(column["Type"], str)
+        for column in response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+    ]
+
+
+def get_query_results(
+    query: str, as_tuples: bool = False, typed: bool = False, cache: bool = True
+) -> Generator[Dict | Tuple, None, None]:
+    result = run_query(query, cache)
+    location = result.get("output_location", "")
+    if (
+        get_results_from_s3()
+        and result.get("status") == "SUCCEEDED"
+        and location.endswith(".csv")
+    ):
+        rows = read_csv_results(location)
+    else:
+        rows = read_paginated_results(result["execution_id"])
+    columns = next(rows, None)
+    if columns is None:
+        return
+    converters = get_column_converters(result["execution_id"]) if typed else None
+    for row in rows:
+        if converters:
+            row = [
+                None if value is None else converters[i](value)
+                for i, value in enumerate(row)
+            ]
+        yield tuple(row) if as_tuples else dict(zip(columns, row))
+
+
+def get_max_query_length() -> int:
+    return int(os.environ.get("MAX_QUERY_LENGTH", "262144"))
+
+
+def get_partition_spec(table_type: TableType, region: str, full_day_str: str) -> str:
+    if table_type == TableType.CLOUD_TRAIL:
+        year = full_day_str[:4]
+        month = full_day_str[5:7]
+        day = full_day_str[-2:]
+        return (
+            f"PARTITION (region= '{region}', year= '{year}', month= '{month}', day= '{day}') "
+            f"LOCATION 's3://{table_type.bucket}/{table_type.folder}/{region}/{year}/{month}/{day}/'"
+        )
+    return f"PARTITION (region='{region}', day='{full_day_str}')"
+
+
+def get_add_partitions_queries(
+    table_type: TableType, days: List[str], regions: List[str]
+) -> List[str]:
+    # Adds as many partitions as possible in each statement without exceeding the
+    # Athena query length limit, which is in UTF-8 bytes
+    header = f"ALTER TABLE {table_type.table_name} ADD IF NOT EXISTS"
+    queries = []
+    sql = header
+    length = len(header.encode("utf-8"))
+    for day in days:
+        for region in regions:
+            partition = f"\n{get_partition_spec(table_type, region, day)}"
+            partition_length = len(partition.encode("utf-8"))
+            if sql != header and length + partition_length > get_max_query_length():
+                queries.append(sql)
+                sql = header
+                length = len(header.encode("utf-8"))
+            sql += partition
+            length += partition_length
+    if sql != header:
+        queries.append(sql)
+    return queries
+
+
+def add_partitions(table_types: List[TableType], days: List[str], regions: List[str]):
+    queries = []
+    for table_type in table_types:
+        queries += get_add_partitions_queries(table_type, days, regions)
+    succeeded = True
+    for index, result in run_queries(queries):
+        if result.get("status") != "SUCCEEDED":
+            logger.warning(f"Failed adding partitions: {queries[index]}. {result}")
+            succeeded = False
+    logger.info(f"Added partitions for {len(days)} days using {len(queries)} queries")
+    return succeeded
 
-    run_query(
-        f"ALTER TABLE {TableType.HISTORY.table_name} "
-        f"ADD IF NOT EXISTS PARTITION (region='{region}', day='{full_day_str}')"
-    )
 
-    alter_sql = f"""ALTER TABLE {TableType.CLOUD_TRAIL.table_name} ADD IF NOT EXISTS 
-PARTITION (region= '{region}', year= '{year}', month= '{month}', day= '{day}') 
-LOCATION 's3://{TableType.CLOUD_TRAIL.bucket}/{TableType.CLOUD_TRAIL.folder}/{region}/{year}/{month}/{day}/'"""
-    run_query(alter_sql)
+def insert_data(full_day_str: str, region: str, add_partition: bool = True) -> dict:
+    if add_partition:
+        for table_type in get_source_table_types():
+            run_query(
+                f"ALTER TABLE {table_type.table_name} ADD IF NOT EXISTS "
+                f"{get_partition_spec(table_type, region, full_day_str)}"
+            )
 
-    insert_sql = f"""
+    select_sql = get_events_select_sql(full_day_str, region)
+    sort_by = get_events_sort_by()
+    if sort_by:
+        result = create_sorted_events(full_day_str, region, select_sql, sort_by)
+    else:
+        result = run_query(f"""
 INSERT INTO {TableType.EVENTS.table_name} (query_id, event_time, user_identity_type,
   user_identity_principal, user_identity_arn, user_agent,
   source_ip, query, database, data_scanned, workgroup, region, day)
-SELECT 
+{select_sql}""")
+    logger.info(f"Inserted data for {full_day_str}, region: {region}. Result: {result}")
+    return result
+
+
+def create_sorted_events(
+    full_day_str: str, region: str, select_sql: str, sort_by: List[str]
+) -> dict:
+    # An INSERT INTO cannot be bucketed, the partition is written by a CTAS into its
+    # location instead, bucketed by the first sort column so each principal is in one
+    # file. An ORDER BY would cost a global sort and is not kept within the buckets
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    temp_table = f"{get_db_name()}.events_{region}_{full_day_str}_{version}".replace(
+        "-", "_"
+    )
+    location = (
+        f"s3://{TableType.EVENTS.bucket}/{get_events_location(region, full_day_str)}/"
+    )
+    columns = ", ".join(f'"{column}"' for column in EVENTS_COLUMNS)
+    result = run_query(f"""CREATE TABLE {temp_table}
+WITH (format = 'PARQUET', write_compression = 'ZSTD',
+      external_location = '{location}',
+      bucketed_by = ARRAY['{sort_by[0]}'], bucket_count = {get_events_bucket_count()})
+AS SELECT {columns} FROM ({select_sql})""")
+    run_query(f"DROP TABLE IF EXISTS {temp_table}")
+    return result
+
+
+def get_events_select_sql(full_day_str: str, region: str) -> str:
+    if get_cloud_trail_extract():
+        return get_select_from_extract_sql(full_day_str, region)
+    year = full_day_str[:4]
+    month = full_day_str[5:7]
+    day = full_day_str[-2:]
+    return f"""SELECT 
   json_extract_scalar(responseelements, '$.queryExecutionId') AS query_id,
   CAST(From_iso8601_timestamp(eventtime) AS TIMESTAMP) AS event_time,
   useridentity.type AS user_identity_type, 
@@ -170,17 +586,570 @@ WHERE eventsource = 'athena.amazonaws.com'
       AND month = '{month}'
       AND ct.day = '{day}'
 """
-    result = run_query(insert_sql)
-    logger.info(f"Inserted data for {full_day_str}, region: {region}. Result: {result}")
+
+
+def get_select_from_extract_sql(full_day_str: str, region: str) -> str:
+    return f"""SELECT
+  ct.query_id,
+  ct.event_time,
+  ct.user_identity_type,
+  ct.user_identity_principal,
+  ct.user_identity_arn,
+  ct.user_agent,
+  ct.source_ip,
+  h.query,
+  ct.database,
+  h.data_scanned,
+  ct.workgroup,
+  ct.region,
+  '{full_day_str}' AS day
+FROM {TableType.CLOUD_TRAIL_ATHENA.table_name} AS ct
+     LEFT OUTER JOIN {TableType.HISTORY.table_name} AS h
+     ON ct.query_id = h.query_id
+        AND h.day = '{full_day_str}' AND h.region = '{region}'
+WHERE ct.region = '{region}'
+      AND ct.day = '{full_day_str}'
+"""
+
+
+def get_cloud_trail_athena_location(region: str, day: str) -> str:
+    return f"{TableType.CLOUD_TRAIL_ATHENA.folder}/region={region}/day={day}"
+
+
+def get_athena_event_record(event: dict) -> dict:
+    request = event.get("requestParameters") or {}
+    context = request.get("queryExecutionContext") or {}
+    identity = event.get("userIdentity") or {}
+    return {
+        "query_id": (event.get("responseElements") or {}).get("queryExecutionId"),
+        "event_time": event.get("eventTime"),
+        "user_identity_type": identity.get("type"),
+        "user_identity_principal": identity.get("principalId"),
+        "user_identity_arn": identity.get("arn"),
+        "user_agent": event.get("userAgent"),
+        "source_ip": event.get("sourceIPAddress"),
+        "database": context.get("database"),
+        "workgroup": request.get("workGroup"),
+    }
+
+
+def read_athena_events(bucket: str, key: str) -> List[dict]:
+    # CloudTrail objects are small gzipped JSON documents, each is decompressed while
+    # being downloaded and only the Athena StartQueryExecution records are kept
+    body = create_client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+    stream = gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body
+    records = json.load(stream).get("Records", [])
+    return [
+        get_athena_event_record(event)
+        for event in records
+        if event.get("eventSource") == "athena.amazonaws.com"
+        and event.get("eventName") == "StartQueryExecution"
+    ]
+
+
+def extract_athena_events(region: str, day: str) -> int:
+    # Written as parquet with a typed event_time, the join reads only its columns and
+    # does not parse JSON or timestamps
+    bucket = TableType.CLOUD_TRAIL.bucket
+    objects = list_objects(bucket, f"{get_cloud_trail_location(region, day)}/")
+    key = f"{get_cloud_trail_athena_location(region, day)}/data.parquet"
+    clear_folder(
+        TableType.CLOUD_TRAIL_ATHENA.bucket,
+        f"{get_cloud_trail_athena_location(region, day)}/",
+    )
+    writer = S3ParquetWriter(
+        TableType.CLOUD_TRAIL_ATHENA.bucket, key, CLOUD_TRAIL_ATHENA_SCHEMA
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_extract_workers()
+        ) as extract_pool:
+            futures = [
+                extract_pool.submit(read_athena_events, bucket, o["Key"])
+                for o in objects
+                if not o["Key"].endswith("/")
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                for record in future.result():
+                    record["event_time"] = parse_event_time(record["event_time"])
+                    writer.write(record)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    logger.info(
+        f"Extracted {writer.rows} Athena events from {len(objects)} CloudTrail objects. "
+        f"Region: {region}, day: {day}"
+    )
+    return writer.rows
+
+
+class HistoryIndex:
+    # query_id -> (query, data_scanned) lookup for the local join. Kept in memory up to
+    # LOCAL_JOIN_MAX_MEMORY_MB, then spilled to a SQLite file on local storage
+    def __init__(self):
+        self.rows = {}
+        self.bytes = 0
+        self.db = None
+        self.db_file = None
+
+    def add(self, query_id: str, query: str, data_scanned: int):
+        if self.db is None:
+            if query_id not in self.rows:
+                self.rows[query_id] = (query, data_scanned)
+                self.bytes += get_record_size(query_id, query, data_scanned)
+            if self.bytes > get_local_join_max_memory_bytes():
+                self._spill()
+        else:
+            self.db.execute(
+                "INSERT OR IGNORE INTO history VALUES (?, ?, ?)",
+                (query_id, query, data_scanned),
+            )
+
+    def _spill(self):
+        # Only needed once the history no longer fits in memory
+        import sqlite3
+        import tempfile
+
+        logger.info(f"Spilling {len(self.rows)} history rows to disk")
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False).name
+        self.db = sqlite3.connect(self.db_file)
+        self.db.execute(
+            "CREATE TABLE history (query_id TEXT PRIMARY KEY, query TEXT, data_scanned INTEGER)"
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO history VALUES (?, ?, ?)",
+            ((query_id, *values) for query_id, values in self.rows.items()),
+        )
+        self.rows = {}
+
+    def get(self, query_id: str) -> Tuple[str, int] | None:
+        if self.db is None:
+            return self.rows.get(query_id)
+        return self.db.execute(
+            "SELECT query, data_scanned FROM history WHERE query_id = ?", (query_id,)
+        ).fetchone()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_file)
+            self.db = None
+
+
+def read_history_records(bucket: str, key: str) -> Generator[dict, None, None]:
+    body = create_client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+    if key.endswith(".parquet"):
+        import pyarrow.parquet
+
+        columns = ["query_id", "query", "data_scanned"]
+        parquet_file = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(body.read()))
+        for batch in parquet_file.iter_batches(columns=columns):
+            yield from batch.to_pylist()
+    elif key.endswith(".json.gz"):
+        for line in gzip.GzipFile(fileobj=body):
+            if line.strip():
+                yield json.loads(line)
+
+
+class SortedRecords:
+    # Sorts the records of a partition. Up to LOCAL_JOIN_MAX_MEMORY_MB of records are
+    # held, then they are sorted and written as a run to local storage. Iterating
+    # merges the runs
+    def __init__(self, key: Callable[[dict], Any]):
+        self.key = key
+        self.records = []
+        self.bytes = 0
+        self.runs = []
+
+    def add(self, record: dict):
+        self.records.append(record)
+        self.bytes += get_record_size(*record.values())
+        if self.bytes > get_local_join_max_memory_bytes():
+            self._spill()
+
+    def _spill(self):
+        import pickle
+        import tempfile
+
+        self.records.sort(key=self.key)
+        run = tempfile.TemporaryFile()
+        for record in self.records:
+            pickle.dump(record, run)
+        run.seek(0)
+        self.runs.append(run)
+        logger.info(f"Spilled a run of {len(self.records)} sorted records to disk")
+        self.records = []
+        self.bytes = 0
+
+    @staticmethod
+    def _read_run(run) -> Generator[dict, None, None]:
+        import pickle
+
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        self.records.sort(key=self.key)
+        if len(self.runs) == 0:
+            return iter(self.records)
+        runs = [self._read_run(run) for run in self.runs]
+        return heapq.merge(*runs, iter(self.records), key=self.key)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+
+def load_history_index(region: str, day: str) -> HistoryIndex:
+    index = HistoryIndex()
+    bucket = TableType.HISTORY.bucket
+    for o in list_objects(bucket, f"{get_history_location(region, day)}/"):
+        for record in read_history_records(bucket, o["Key"]):
+            index.add(record["query_id"], record["query"], record["data_scanned"])
+    return index
+
+
+CLOUD_TRAIL_ATHENA_SCHEMA = [
+    ("query_id", "string"),
+    ("event_time", "timestamp"),
+    ("user_identity_type", "string"),
+    ("user_identity_principal", "string"),
+    ("user_identity_arn", "string"),
+    ("user_agent", "string"),
+    ("source_ip", "string"),
+    ("database", "string"),
+    ("workgroup", "string"),
+]
+
+EVENTS_SCHEMA = [
+    ("query_id", "string"),
+    ("event_time", "timestamp"),
+    ("user_identity_type", "string"),
+    ("user_identity_principal", "string"),
+    ("user_identity_arn", "string"),
+    ("source_ip", "string"),
+    ("user_agent", "string"),
+    ("workgroup", "string"),
+    ("query", "string"),
+    ("database", "string"),
+    ("data_scanned", "int64"),
+]
+
+
+def parse_event_time(event_time: str) -> datetime | None:
+    # Same as CAST(From_iso8601_timestamp(eventtime) AS TIMESTAMP), UTC without zone
+    if not event_time:
+        return None
+    parsed = datetime.fromisoformat(event_time)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def insert_data_local(
+    full_day_str: str, region: str, add_partition: bool = True
+) -> dict:
+    # Joins the day's CloudTrail Athena events with the history in this process and
+    # writes the events partition directly, without running any Athena query
+    if add_partition:
+        run_query(
+            f"ALTER TABLE {TableType.EVENTS.table_name} ADD IF NOT EXISTS "
+            f"{get_partition_spec(TableType.EVENTS, region, full_day_str)}"
+        )
+    history = load_history_index(region, full_day_str)
+    bucket = TableType.CLOUD_TRAIL.bucket
+    objects = list_objects(bucket, f"{get_cloud_trail_location(region, full_day_str)}/")
+    key = f"{get_events_location(region, full_day_str)}/events.parquet"
+    writer = S3ParquetWriter(
+        TableType.EVENTS.bucket,
+        key,
+        EVENTS_SCHEMA,
+        row_group_size=get_events_row_group_size(),
+    )
+    sort_by = get_events_sort_by()
+    sorted_records = SortedRecords(
+        lambda r: tuple((r[c] is None, r[c]) for c in sort_by)
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_extract_workers()
+        ) as extract_pool:
+            futures = [
+                extract_pool.submit(read_athena_events, bucket, o["Key"])
+                for o in objects
+                if not o["Key"].endswith("/")
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                for record in future.result():
+                    query, data_scanned = history.get(record["query_id"]) or (
+                        None,
+                        None,
+                    )
+                    record["event_time"] = parse_event_time(record["event_time"])
+                    record["query"] = query
+                    record["data_scanned"] = data_scanned
+                    if sort_by:
+                        sorted_records.add(record)
+                    else:
+                        writer.write(record)
+        for record in sorted_records:
+            writer.write(record)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        history.close()
+        sorted_records.close()
+    logger.info(
+        f"Inserted {writer.rows} events locally for {full_day_str}, region: {region}"
+    )
+    return {"status": "SUCCEEDED", "rows": writer.rows}
+
+
+def get_events_location(region: str, day: str) -> str:
+    return f"{TableType.EVENTS.folder}/region={region}/day={day}"
+
+
+def get_cloud_trail_location(region: str, day: str) -> str:
+    return f"{TableType.CLOUD_TRAIL.folder}/{region}/{day[:4]}/{day[5:7]}/{day[-2:]}"
+
+
+def get_history_location(region: str, day: str) -> str:
+    return f"{TableType.HISTORY.folder}/region={region}/day={day}"
+
+
+def get_compacted_location(region: str, day: str) -> str:
+    return f"{TableType.EVENTS.folder}/_compacted/region={region}/day={day}"
+
+
+def get_manifest_key(region: str, day: str) -> str:
+    return f"{TableType.EVENTS.folder}/_manifests/region={region}/day={day}.json"
+
+
+def get_inputs_manifest(region: str, day: str) -> dict:
+    # The objects the events partition is built from, any change in one of them
+    # (added, removed or rewritten object) changes the manifest
+    inputs = {
+        "cloud_trail": (
+            TableType.CLOUD_TRAIL.bucket,
+            get_cloud_trail_location(region, day),
+        ),
+        "history": (TableType.HISTORY.bucket, get_history_location(region, day)),
+    }
+    return {
+        name: sorted(
+            [o["Key"], o["ETag"], o["Size"]] for o in list_objects(bucket, f"{prefix}/")
+        )
+        for name, (bucket, prefix) in inputs.items()
+    }
+
+
+def is_partition_unchanged(
+    region: str, day: str, manifest: dict, manifest_keys: Set[str] = None
+) -> bool:
+    if manifest_keys is not None and get_manifest_key(region, day) not in manifest_keys:
+        return False
+    s3_client = create_client("s3")
+    try:
+        response = s3_client.get_object(
+            Bucket=TableType.EVENTS.bucket, Key=get_manifest_key(region, day)
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return False
+        raise e
+    return json.loads(response["Body"].read()) == manifest
+
+
+def put_partition_manifest(region: str, day: str, manifest: dict):
+    create_client("s3").put_object(
+        Bucket=TableType.EVENTS.bucket,
+        Key=get_manifest_key(region, day),
+        Body=json.dumps(manifest).encode("utf-8"),
+    )
+
+
+def process_partition(
+    day: str,
+    region: str,
+    add_partition: bool = True,
+    force: bool = False,
+    engine: str = "athena",
+    manifest_keys: Set[str] = None,
+) -> dict:
+    logger.info(f"Current region: {region}, day: {day}")
+    status = {"region": region, "day": day}
+    try:
+        manifest = get_inputs_manifest(region, day)
+        if not force and is_partition_unchanged(region, day, manifest, manifest_keys):
+            logger.info(f"Inputs unchanged, skipping region: {region}, day: {day}")
+            status["status"] = "SKIPPED"
+            return status
+        if not get_partition_projection():
+            reset_partition_location(region, day)
+        clear_folder(TableType.EVENTS.bucket, get_events_location(region, day))
+        if engine == "local":
+            result = insert_data_local(day, region, add_partition)
+        else:
+            if get_cloud_trail_extract():
+                status["extracted"] = extract_athena_events(region, day)
+            result = insert_data(day, region, add_partition)
+        status["status"] = result.get("status", "FAILED")
+        if "error" in result:
+            status["error"] = result["error"]
+        if status["status"] == "SUCCEEDED":
+            put_partition_manifest(region, day, manifest)
+    except Exception as e:
+        logger.exception(f"Failed processing region: {region}, day: {day}")
+        status["status"] = "FAILED"
+        status["error"] = str(e)
+    return status
+
+
+def process_partitions(
+    days: List[str],
+    regions: List[str],
+    add_partition: bool = True,
+    force: bool = False,
+    engine: str = "athena",
+) -> List[dict]:
+    # One listing tells which partitions have a manifest to compare with
+    manifest_keys = list_keys(
+        TableType.EVENTS.bucket, f"{TableType.EVENTS.folder}/_manifests/"
+    )
+    # Each partition runs its queries one after the other, so the number of workers is
+    # the number of queries running at the same time
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_max_concurrent_queries()
+    ) as partitions_pool:
+        futures = [
+            partitions_pool.submit(
+                process_partition,
+                day,
+                region,
+                add_partition,
+                force,
+                engine,
+                manifest_keys,
+            )
+            for day in days
+            for region in regions
+        ]
+        return [future.result() for future in futures]
+
+
+EVENTS_COLUMNS = [
+    "query_id",
+    "event_time",
+    "user_identity_type",
+    "user_identity_principal",
+    "user_identity_arn",
+    "source_ip",
+    "user_agent",
+    "workgroup",
+    "query",
+    "database",
+    "data_scanned",
+]
+
+
+def reset_partition_location(region: str, day: str):
+    # A compacted partition points to a _compacted folder, it is moved back to its
+    # default location before being rebuilt
+    compacted = list_objects(
+        TableType.EVENTS.bucket, f"{get_compacted_location(region, day)}/"
+    )
+    if len(compacted) == 0:
+        return
+    location = f"s3://{TableType.EVENTS.bucket}/{get_events_location(region, day)}/"
+    run_query(
+        f"ALTER TABLE {TableType.EVENTS.table_name} "
+        f"{get_partition_spec(TableType.EVENTS, region, day)} SET LOCATION '{location}'"
+    )
+    delete_objects(TableType.EVENTS.bucket, [o["Key"] for o in compacted])
+
+
+def compact_partition(day: str, region: str) -> dict:
+    # Rewrites the partition into files of about COMPACTION_TARGET_FILE_MB under a new
+    # _compacted folder, then switches the partition location with a single ALTER
+    # TABLE, so readers see either the old or the new files
+    logger.info(f"Compacting region: {region}, day: {day}")
+    status = {"region": region, "day": day}
+    bucket = TableType.EVENTS.bucket
+    old_objects = list_objects(bucket, f"{get_events_location(region, day)}/")
+    old_objects += list_objects(bucket, f"{get_compacted_location(region, day)}/")
+    if len(old_objects) <= 1:
+        status["status"] = "SKIPPED"
+        return status
+    files = math.ceil(
+        sum(o["Size"] for o in old_objects) / get_compaction_target_size()
+    )
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    prefix = f"{get_compacted_location(region, day)}/{version}/"
+    temp_table = f"{get_db_name()}.compact_{region}_{day}_{version}".replace("-", "_")
+    columns = ", ".join(f'"{column}"' for column in EVENTS_COLUMNS)
+    # Bucketing groups each principal in one file, an ORDER BY is not kept within the
+    # buckets
+    bucket_by = (get_events_sort_by() or ["user_identity_arn"])[0]
+    result = run_query(f"""CREATE TABLE {temp_table}
+WITH (format = 'PARQUET', write_compression = 'ZSTD',
+      external_location = 's3://{bucket}/{prefix}',
+      bucketed_by = ARRAY['{bucket_by}'], bucket_count = {max(1, files)})
+AS SELECT {columns} FROM {TableType.EVENTS.table_name}
+WHERE region = '{region}' AND day = '{day}'""")
+    run_query(f"DROP TABLE IF EXISTS {temp_table}")
+    if result.get("status") == "SUCCEEDED":
+        result = run_query(
+            f"ALTER TABLE {TableType.EVENTS.table_name} "
+            f"{get_partition_spec(TableType.EVENTS, region, day)} "
+            f"SET LOCATION 's3://{bucket}/{prefix}'"
+        )
+    if result.get("status") != "SUCCEEDED":
+        clear_folder(bucket, prefix)
+        status["status"] = "FAILED"
+        status["error"] = result.get("error")
+        return status
+    delete_objects(bucket, [o["Key"] for o in old_objects])
+    logger.info(f"Compacted {len(old_objects)} objects of region: {region}, day: {day}")
+    status["status"] = "SUCCEEDED"
+    status["objects"] = len(old_objects)
+    status["compacted_objects"] = len(list_objects(bucket, prefix))
+    return status
+
+
+def safe_compact_partition(day: str, region: str) -> dict:
+    try:
+        return compact_partition(day, region)
+    except Exception as e:
+        logger.exception(f"Failed compacting region: {region}, day: {day}")
+        return {"region": region, "day": day, "status": "FAILED", "error": str(e)}
+
+
+def compact_partitions(days: List[str], regions: List[str]) -> List[dict]:
+    if get_partition_projection():
+        raise ValueError(
+            "Compaction moves partition locations, it is not supported with partition projection"
+        )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_max_concurrent_queries()
+    ) as partitions_pool:
+        futures = [
+            partitions_pool.submit(safe_compact_partition, day, region)
+            for day in days
+            for region in regions
+        ]
+        return [future.result() for future in futures]
 
 
 def repair_events_table(days_back: int):
-    sql = f"ALTER TABLE {TableType.EVENTS.table_name} ADD IF NOT EXISTS"
-    for i in range(days_back, 0, -1):
-        day = get_day_back(i)
-        for region in get_regions():
-            sql += f"\nPARTITION (region='{region}', day='{day}')"
-    run_query(sql)
+    days = [get_day_back(i) for i in range(days_back, 0, -1)]
+    add_partitions([TableType.EVENTS], days, get_regions())
 
 
 def tables_exist(tables: List[str]) -> bool:
@@ -189,18 +1158,68 @@ def tables_exist(tables: List[str]) -> bool:
         sql += f"(SELECT 1 FROM {table} LIMIT 1)"
         if idx < len(tables) - 1:
             sql += " UNION ALL "
-    result = run_query(sql)
+    # A cached answer would hide tables dropped since
+    result = run_query(sql, cache=False)
     return "error" not in result
 
 
-def create_table(table_type: TableType):
-    run_query(f"DROP TABLE IF EXISTS {table_type.table_name}")
-    file_name = os.path.join(
+def get_table_resource(table_type: TableType) -> str:
+    name = table_type.name.lower()
+    if table_type == TableType.HISTORY and get_history_format() == "parquet":
+        name += "_parquet"
+    return os.path.join(
         Path(os.path.dirname(os.path.abspath(__file__))).absolute(),
-        f"resources/create_{table_type.name.lower()}_table.sql",
+        f"resources/create_{name}_table.sql",
     )
+
+
+def get_projection_properties(table_type: TableType) -> Dict[str, str]:
+    # Athena computes the partitions from these properties, so partitions never have to
+    # be added. Regions added to REGIONS later require the tables to be recreated
+    location = f"s3://{table_type.bucket}/{table_type.folder}"
+    properties = {
+        "projection.enabled": "true",
+        "projection.region.type": "enum",
+        "projection.region.values": ",".join(get_regions()),
+    }
+    if table_type == TableType.CLOUD_TRAIL:
+        properties.update(
+            {
+                "projection.year.type": "integer",
+                "projection.year.range": f"{get_projection_start_day()[:4]},2099",
+                "projection.month.type": "integer",
+                "projection.month.range": "1,12",
+                "projection.month.digits": "2",
+                "projection.day.type": "integer",
+                "projection.day.range": "1,31",
+                "projection.day.digits": "2",
+                "storage.location.template": f"{location}/${{region}}/${{year}}/${{month}}/${{day}}/",
+            }
+        )
+    else:
+        properties.update(
+            {
+                "projection.day.type": "date",
+                "projection.day.format": "yyyy-MM-dd",
+                "projection.day.range": f"{get_projection_start_day()},NOW",
+                "projection.day.interval": "1",
+                "projection.day.interval.unit": "DAYS",
+                "storage.location.template": f"{location}/region=${{region}}/day=${{day}}",
+            }
+        )
+    return properties
+
+
+@functools.lru_cache
+def load_sql_template(file_name: str) -> str:
     with open(file_name, "r") as file:
-        sql = file.read()
+        return file.read()
+
+
+def get_table_sql(table_type: TableType, partition_projection: bool = None) -> str:
+    if partition_projection is None:
+        partition_projection = get_partition_projection()
+    sql = load_sql_template(get_table_resource(table_type))
     keywords = {
         "table": table_type.table_name,
         "bucket": table_type.bucket,
@@ -208,24 +1227,121 @@ def create_table(table_type: TableType):
     }
     for key in keywords:
         sql = sql.replace(f"{{{key}}}", keywords[key])
-    result = run_query(sql)
+    if partition_projection:
+        properties = get_projection_properties(table_type)
+        sql += "\nTBLPROPERTIES (\n"
+        sql += ",\n".join(f"  '{k}'='{v}'" for k, v in properties.items())
+        sql += ")"
+    return sql
+
+
+def create_table(table_type: TableType, partition_projection: bool = None) -> dict:
+    run_query(f"DROP TABLE IF EXISTS {table_type.table_name}")
+    result = run_query(get_table_sql(table_type, partition_projection))
     logger.info(f"Table {table_type.table_name} created. Result: {result}")
+    return result
+
+
+def get_schema_initialized() -> bool:
+    return os.environ.get("SCHEMA_INITIALIZED", "false").lower() == "true"
+
+
+def get_schema_marker_key() -> str:
+    # The marker is named after the table definitions, so after changing any of them
+    # (format, projection, regions) the next invocation checks again that the tables
+    # exist. Existing tables are not recreated, a changed definition only applies once
+    # the table is dropped
+    version = hashlib.sha256(
+        "\n".join(get_table_sql(t) for t in get_table_types()).encode()
+    ).hexdigest()
+    return f"{TableType.EVENTS.folder}/_schema/{version}"
+
+
+# Schema versions known to be initialized by this execution environment
+_initialized_schemas: Set[str] = set()
+
+
+def catalog_tables_exist(tables: List[str]) -> bool:
+    # One GetTable call per table, no Athena query is started
+    glue = create_client("glue")
+    for table in tables:
+        database, _, name = table.partition(".")
+        try:
+            glue.get_table(DatabaseName=database, Name=name)
+        except glue.exceptions.EntityNotFoundException:
+            logger.info(f"Table {table} no longer exists")
+            return False
+    return True
 
 
 def init_database(repair_days_back: int):
-    if not tables_exist([t.table_name for t in TableType]):
+    if get_schema_initialized():
+        return False
+    marker_key = get_schema_marker_key()
+    tables = [t.table_name for t in get_table_types()]
+    # The marker skips the Athena check, the catalog still tells about tables which
+    # were dropped since
+    if (
+        marker_key in _initialized_schemas
+        or obj_exists(TableType.EVENTS.bucket, marker_key)
+    ) and catalog_tables_exist(tables):
+        _initialized_schemas.add(marker_key)
+        return False
+    created = False
+    succeeded = True
+    if not tables_exist(tables):
         logger.info("Tables do not exist. Creating tables...")
         if get_db_name() != "default":
             run_query(f"CREATE DATABASE {get_db_name()}")
-        for table_type in TableType:
-            create_table(table_type)
-        repair_events_table(repair_days_back)
+        for table_type in get_table_types():
+            result = create_table(table_type)
+            succeeded = succeeded and result["status"] == "SUCCEEDED"
+        if not get_partition_projection():
+            repair_events_table(repair_days_back)
         logger.info(f"Finished creating tables")
-        return True
-    return False
+        created = True
+    if succeeded:
+        create_client("s3").put_object(
+            Bucket=TableType.EVENTS.bucket, Key=marker_key, Body=b""
+        )
+        _initialized_schemas.add(marker_key)
+    return created
+
+
+def orchestrate(
+    days: List[str],
+    regions: List[str],
+    force: bool,
+    engine: str,
+    run_id: str = None,
+    resume: dict = None,
+) -> dict:
+    units = [
+        {"day": day, "regions": region, "force": force, "engine": engine}
+        for day in days
+        for region in regions
+    ]
+    state_prefix = get_run_prefix(
+        f"{TableType.EVENTS.folder}/_orchestrations", units, run_id
+    )
+    result = fan_out(
+        lambda_handler, units, TableType.EVENTS.bucket, state_prefix, resume
+    )
+    return {"run_id": run_id, **result}
 
 
 def lambda_handler(event, context):
+    metrics.reset()
+    result = handle_event(event)
+    if get_telemetry():
+        metrics.emit(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "athena_events"))
+        result["telemetry"] = metrics.summary()
+    return result
+
+
+def handle_event(event: dict) -> dict:
+    if get_query_cache_max_age() > 0:
+        evict_query_cache()
     init_database(event.get("repair_days_back", 90))
     if "day" in event:
         from_day = event["day"]
@@ -237,19 +1353,47 @@ def lambda_handler(event, context):
     result = {}
     logger.info(f"START. from day: {from_day}, to day: {to_day}")
     regions = event["regions"].split(",") if "regions" in event else get_regions()
-    for day in get_days(from_day, to_day):
-        for region in regions:
-            logger.info(f"Current region: {region}, day: {day}")
-            clear_folder(
-                TableType.EVENTS.bucket,
-                f"{TableType.EVENTS.folder}/region={region}/day={day}",
-            )
-            insert_data(day, region)
+    days = list(get_days(from_day, to_day))
+    if event.get("mode") == "compact":
+        partitions = compact_partitions(days, regions)
+        logger.info(f"FINISH compaction. from day: {from_day}, to day: {to_day}")
+        return {"from_day": from_day, "to_day": to_day, "partitions": partitions}
+    engine = event.get("engine", "athena")
+    if engine not in ["athena", "local"]:
+        raise ValueError(f"Unsupported engine: {engine}")
+    if event.get("mode") == "orchestrate":
+        run_id = get_run_id(event)
+        result = orchestrate(
+            days,
+            regions,
+            event.get("force", False),
+            engine,
+            run_id,
+            {**event, "run_id": run_id},
+        )
+        logger.info(f"FINISH orchestration. from day: {from_day}, to day: {to_day}")
+        return {"from_day": from_day, "to_day": to_day, **result}
+    # Partitions are added up front with a few statements, if that fails every
+    # partition falls back to adding its own
+    added = get_partition_projection() or add_partitions(
+        get_source_table_types(engine), days, regions
+    )
+    partitions = process_partitions(
+        days,
+        regions,
+        add_partition=not added,
+        force=event.get("force", False),
+        engine=engine,
+    )
+    failed = [p for p in partitions if p["status"] not in ["SUCCEEDED", "SKIPPED"]]
+    if len(failed) > 0:
+        logger.warning(f"{len(failed)} partitions failed: {failed}")
     events_count = int(
         list(
             get_query_results(
                 f"SELECT COUNT() AS events FROM {TableType.EVENTS.table_name} "
-                f"WHERE day BETWEEN '{from_day}' AND '{to_day}'"
+                f"WHERE day BETWEEN '{from_day}' AND '{to_day}'",
+                cache=False,
             )
         )[0]["events"]
     )
@@ -260,5 +1404,11 @@ def lambda_handler(event, context):
     result["from_day"] = from_day
     result["to_day"] = to_day
     result["events"] = events_count
+    result["partitions"] = partitions
+    # A unit with failed partitions is dispatched again when its orchestration is rerun
+    if len(failed) == 0:
+        complete_unit(event, result)
+    else:
+        release_unit(event)
 
     return result
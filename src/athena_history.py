@@ -3,18 +3,30 @@ import gzip
 import json
 import logging
 import os
-import shutil
-import tempfile
-from datetime import date, datetime
-from typing import List, Generator, Dict
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Generator, Dict, Set
 
-import boto3
 
 from common_utils import (
+    create_client,
     get_days,
     clear_folder,
+    list_keys,
     obj_exists,
     get_yesterday,
+    AdaptiveWindow,
+    S3MultipartWriter,
+    S3ParquetWriter,
+    get_history_format,
+    get_run_id,
+    get_run_prefix,
+    fan_out,
+    complete_unit,
+    get_telemetry,
+    metrics,
 )
 
 logger = logging.getLogger()
@@ -29,61 +41,315 @@ def get_region():
     return os.environ["AWS_REGION"]
 
 
+def get_regions() -> List[str]:
+    # Regions collected by one invocation, the function's own region by default
+    regions = os.environ.get("REGIONS", "")
+    return regions.split(",") if regions else [get_region()]
+
+
 def get_location() -> str:
     location = os.environ.get("FOLDER", "athena_audit/history")
     return location[:-1] if location.endswith("/") else location
 
 
-def get_daily_location(day: str) -> str:
-    return f"{get_location()}/region={get_region()}/day={day}"
+def get_daily_location(day: str, region: str = None) -> str:
+    return f"{get_location()}/region={region or get_region()}/day={day}"
+
+
+def get_daily_location_workgroup(day: str, workgroup: str, region: str = None) -> str:
+    return f"{get_daily_location(day, region)}/workgroup={workgroup}"
+
+
+def get_history_key(
+    day: str, workgroup: str, part: str = None, region: str = None
+) -> str:
+    file_name = "data" if part is None else f"data-{part}"
+    file_name += ".parquet" if get_history_format() == "parquet" else ".json.gz"
+    return f"{get_daily_location_workgroup(day, workgroup, region)}/{file_name}"
+
+
+def get_query_ids_key(day: str, workgroup: str, region: str = None) -> str:
+    # Athena skips files starting with an underscore, the index is not read as history
+    return f"{get_daily_location_workgroup(day, workgroup, region)}/_query_ids.gz"
+
+
+def load_query_ids(day: str, workgroup: str, s3_client, region: str = None) -> Set[str]:
+    try:
+        response = s3_client.get_object(
+            Bucket=get_bucket(), Key=get_query_ids_key(day, workgroup, region)
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return set()
+        raise e
+    return set(gzip.decompress(response["Body"].read()).decode("utf-8").split())
+
+
+def save_query_ids(
+    day: str, workgroup: str, query_ids: Set[str], s3_client, region: str = None
+):
+    # Sorted and gzipped, about 20 bytes per query id
+    s3_client.put_object(
+        Bucket=get_bucket(),
+        Key=get_query_ids_key(day, workgroup, region),
+        Body=gzip.compress("\n".join(sorted(query_ids)).encode("utf-8")),
+    )
+
+
+def get_watermarks_location(region: str = None) -> str:
+    return f"{get_location()}/_watermarks/region={region or get_region()}"
+
+
+def get_watermark_key(workgroup: str, region: str = None) -> str:
+    return f"{get_watermarks_location(region)}/workgroup={workgroup}.json"
+
+
+def get_workgroup_workers() -> int:
+    return int(os.environ.get("WORKGROUP_WORKERS", "4"))
+
+
+def get_region_workers() -> int:
+    # Each region runs its own workgroup pool, the S3 client is shared by all of them
+    return int(os.environ.get("REGION_WORKERS", "4"))
+
+
+def get_max_api_calls() -> int:
+    return int(os.environ.get("MAX_API_CALLS", "10"))
+
+
+def get_max_fetch_window() -> int:
+    return int(os.environ.get("MAX_FETCH_WINDOW", "8"))
 
 
-def get_daily_location_workgroup(day: str, workgroup: str) -> str:
-    return f"{get_location()}/region={get_region()}/day={day}/workgroup={workgroup}"
+def get_late_margin_minutes() -> int:
+    # Should cover the longest query runtime (the workgroups' query timeouts)
+    return int(os.environ.get("LATE_MARGIN_MINUTES", "60"))
 
 
-def get_history_key(day: str, workgroup: str) -> str:
-    return f"{get_daily_location_workgroup(day, workgroup)}/data.json.gz"
+def get_max_open_days() -> int:
+    return int(os.environ.get("MAX_OPEN_DAYS", "4"))
+
+
+class Watermark:
+    # The newest query execution collected for a workgroup. Executions are listed newest
+    # first, so a run can stop paging once it reaches the watermark. Executions that
+    # were still running (or belong to a day after to_day) hold the watermark back,
+    # and the ones collected above it are remembered so they are not written twice
+    def __init__(
+        self,
+        query_execution_id: str = None,
+        completion_date_time: str = None,
+        collected_ids: List[str] = None,
+    ):
+        self.query_execution_id = query_execution_id
+        self.completion_date_time = completion_date_time
+        self.collected_ids = set(collected_ids or [])
+        self._observed = []
+        self._completion_times = {}
+        self._last_not_collected = None
+
+    @staticmethod
+    def load(workgroup: str, s3_client, region: str = None) -> "Watermark":
+        try:
+            response = s3_client.get_object(
+                Bucket=get_bucket(), Key=get_watermark_key(workgroup, region)
+            )
+        except s3_client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+                return Watermark()
+            raise e
+        return Watermark(**json.loads(response["Body"].read()))
+
+    def save(self, workgroup: str, s3_client, region: str = None):
+        s3_client.put_object(
+            Bucket=get_bucket(),
+            Key=get_watermark_key(workgroup, region),
+            Body=json.dumps(self.next()).encode("utf-8"),
+        )
+
+    def reached(self, query_execution_id: str) -> bool:
+        return query_execution_id == self.query_execution_id
+
+    def is_collected(self, query_execution_id: str) -> bool:
+        return query_execution_id in self.collected_ids
+
+    def observe(self, query: dict, collected: bool):
+        if not collected:
+            self._last_not_collected = len(self._observed)
+        self._observed.append((query["QueryExecutionId"], collected))
+        if "CompletionDateTime" in query["Status"]:
+            self._completion_times[query["QueryExecutionId"]] = query["Status"][
+                "CompletionDateTime"
+            ].isoformat()
+
+    def next(self) -> dict:
+        if self._last_not_collected is None:
+            boundary = 0
+            collected_ids = []
+        else:
+            boundary = self._last_not_collected + 1
+            collected_ids = [
+                i for i, collected in self._observed[:boundary] if collected
+            ]
+        if boundary < len(self._observed):
+            query_execution_id = self._observed[boundary][0]
+            completion_date_time = self._completion_times.get(query_execution_id)
+        else:
+            # Nothing older than the held back executions was observed, keep the old
+            # watermark together with the executions already collected above it
+            query_execution_id = self.query_execution_id
+            completion_date_time = self.completion_date_time
+            collected_ids += list(self.collected_ids)
+        return {
+            "query_execution_id": query_execution_id,
+            "completion_date_time": completion_date_time,
+            "collected_ids": collected_ids,
+        }
+
+
+def create_history_for_workgroup(
+    from_day: str,
+    to_day: str,
+    workgroup: str,
+    athena,
+    s3_client,
+    api_calls: threading.Semaphore,
+    incremental: bool = False,
+    existing_keys: Set[str] = None,
+    region: str = None,
+    append: bool = False,
+    counts: Dict[str, int] = None,
+) -> int:
+    if incremental:
+        watermark = Watermark.load(workgroup, s3_client, region)
+        logger.info(
+            f"Current workgroup: {workgroup}. Watermark: {watermark.query_execution_id}"
+        )
+        records = create_history_day_for_workgroup(
+            from_day, to_day, workgroup, athena, s3_client, api_calls, watermark, region
+        )
+        watermark.save(workgroup, s3_client, region)
+        logger.info(f"Queries for workgroup {workgroup} written: {records}")
+        return records
+    if append:
+        records = create_history_day_for_workgroup(
+            from_day,
+            to_day,
+            workgroup,
+            athena,
+            s3_client,
+            api_calls,
+            None,
+            region,
+            True,
+            counts,
+        )
+        logger.info(f"Queries for workgroup {workgroup} appended: {records}")
+        return records
+    key = get_history_key(from_day, workgroup, region=region)
+    if existing_keys is None:
+        data_exists = obj_exists(get_bucket(), key, s3_client)
+    else:
+        data_exists = key in existing_keys
+    logger.info(f"Current workgroup: {workgroup}. Data Exists: {data_exists}")
+    if data_exists:
+        return -1
+    records = create_history_day_for_workgroup(
+        from_day,
+        to_day,
+        workgroup,
+        athena,
+        s3_client,
+        api_calls,
+        region=region,
+        counts=counts,
+    )
+    logger.info(f"Queries for workgroup {workgroup} written: {records}")
+    return records
 
 
 def create_history_days_range(
-    from_day: str, to_day: str, workgroup: str = None, clear: bool = False
+    from_day: str,
+    to_day: str,
+    workgroup: str = None,
+    clear: bool = False,
+    incremental: bool = False,
+    region: str = None,
+    append: bool = False,
 ) -> Dict[str, any]:
     if clear:
         for day in get_days(from_day, to_day):
             if workgroup:
-                path = get_daily_location_workgroup(day, workgroup)
+                path = get_daily_location_workgroup(day, workgroup, region)
+            else:
+                path = get_daily_location(day, region)
+            clear_folder(get_bucket(), path)
+        if incremental:
+            if workgroup:
+                path = get_watermark_key(workgroup, region)
             else:
-                path = get_daily_location(day)
+                path = f"{get_watermarks_location(region)}/"
             clear_folder(get_bucket(), path)
+    athena = create_client("athena", region)
+    s3_client = create_client("s3")
     if workgroup is None:
-        client = boto3.client("athena")
         workgroups: List[str] = [
-            w["Name"] for w in client.list_work_groups()["WorkGroups"]
+            w["Name"] for w in athena.list_work_groups()["WorkGroups"]
         ]
     else:
         workgroups = [workgroup]
+    api_calls = threading.BoundedSemaphore(get_max_api_calls())
+    # One listing of the day tells which workgroups were already collected. Only the
+    # full runs check, and a single workgroup is checked with one request
+    existing_keys = None
+    if not incremental and not append and len(workgroups) > 1:
+        existing_keys = list_keys(
+            get_bucket(), f"{get_daily_location(from_day, region)}/", s3_client
+        )
     exists = 0
     total_records = 0
-    for w in workgroups:
-        key = get_history_key(from_day, w)
-        data_exists = obj_exists(get_bucket(), key)
-        logger.info(f"Current workgroup: {w}. Data Exists: {data_exists}")
-        if data_exists:
-            exists += 1
-        else:
-            records = create_history_day_for_workgroup(from_day, to_day, workgroup=w)
-            logger.info(f"Queries for workgroup {w} written: {records}")
-            total_records += records
+    counts = {w: {} for w in workgroups}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_workgroup_workers()
+    ) as workgroup_pool:
+        futures = [
+            workgroup_pool.submit(
+                create_history_for_workgroup,
+                from_day,
+                to_day,
+                w,
+                athena,
+                s3_client,
+                api_calls,
+                incremental,
+                existing_keys,
+                region,
+                append,
+                counts[w],
+            )
+            for w in workgroups
+        ]
+        for future in futures:
+            records = future.result()
+            if records < 0:
+                exists += 1
+            else:
+                total_records += records
     if exists > 0:
         logger.info(f"Data existed for {exists} workgroups")
-    return {
+    result = {
         "from_day": from_day,
         "to_day": to_day,
         "workgroups": len(workgroups),
         "data-exists-workgroups": exists,
         "records": total_records,
     }
+    # Executions still running when listed, collected by a later run of their day
+    dropped = sum(c.get("dropped", 0) for c in counts.values())
+    if dropped > 0:
+        logger.info(f"{dropped} running executions dropped")
+        result["dropped"] = dropped
+    return result
 
 
 def get_query_exec_day(query_exe: dict) -> str:
@@ -91,102 +357,354 @@ def get_query_exec_day(query_exe: dict) -> str:
     return query_date.strftime("%Y-%m-%d")
 
 
+def is_before_margin(query_exe: dict, from_day: str) -> bool:
+    # Executions are listed by submission, a query submitted before from_day may still
+    # complete on it. Once submissions are older than from_day by more than the longest
+    # runtime, no later listed query can complete on from_day or after it
+    submitted = query_exe["Status"].get("SubmissionDateTime") or query_exe[
+        "Status"
+    ].get("CompletionDateTime")
+    if submitted is None:
+        return False
+    start = datetime.strptime(from_day, "%Y-%m-%d").replace(tzinfo=submitted.tzinfo)
+    return submitted < start - timedelta(minutes=get_late_margin_minutes())
+
+
 def get_query_executions_data(athena, ids: List[str]) -> dict:
     return athena.batch_get_query_execution(QueryExecutionIds=ids)
 
 
+def fetch_query_executions_data(
+    athena, ids: List[str], api_calls: threading.Semaphore, window: AdaptiveWindow
+) -> dict:
+    # Throttled calls are retried by the client, the window shrinks when they were
+    start = time.monotonic()
+    with api_calls:
+        result = get_query_executions_data(athena, ids)
+    if result.get("ResponseMetadata", {}).get("RetryAttempts"):
+        window.on_throttle()
+    else:
+        window.on_success(time.monotonic() - start)
+    return result
+
+
 def get_query_executions_for_workgroup(
-    workgroup: str, from_day: str
+    workgroup: str,
+    from_day: str,
+    athena=None,
+    api_calls: threading.Semaphore = None,
+    watermark: Watermark = None,
+    counts: Dict[str, int] = None,
 ) -> Generator[dict, None, None]:
-    athena = boto3.client("athena")
-    max_workers = 3
-    paginator = iter(
+    # counts, when given, gets the number of executions dropped because they were
+    # still running
+    athena = athena or create_client("athena")
+    api_calls = api_calls or threading.BoundedSemaphore(get_max_api_calls())
+    window = AdaptiveWindow(get_max_fetch_window())
+    pages = iter(
         athena.get_paginator("list_query_executions").paginate(WorkGroup=workgroup)
     )
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threat_pool:
-        while True:
-            futures = []
-            for _ in range(max_workers):
-                try:
-                    page = next(paginator)
-                except StopIteration:
-                    break
-                if len(page["QueryExecutionIds"]) > 0:
-                    futures.append(
-                        threat_pool.submit(
-                            get_query_executions_data, athena, page["QueryExecutionIds"]
+    pending = deque()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=window.max_size
+    ) as threat_pool:
+        try:
+            while True:
+                # Keep the window full, results are consumed in the order pages were read
+                while pages is not None and len(pending) < window.size:
+                    try:
+                        with api_calls:
+                            page = next(pages)
+                    except StopIteration:
+                        pages = None
+                        break
+                    if len(page["QueryExecutionIds"]) > 0:
+                        pending.append(
+                            threat_pool.submit(
+                                fetch_query_executions_data,
+                                athena,
+                                page["QueryExecutionIds"],
+                                api_calls,
+                                window,
+                            )
                         )
-                    )
-            if len(futures) == 0:
-                return
-            # Wait for all futures to complete, in the same order they were created
-            for future in futures:
-                query_executions = future.result()
+                if len(pending) == 0:
+                    return
+                query_executions = pending.popleft().result()
                 for query in query_executions["QueryExecutions"]:
+                    if watermark:
+                        if watermark.reached(query["QueryExecutionId"]):
+                            return
+                        if watermark.is_collected(query["QueryExecutionId"]):
+                            watermark.observe(query, collected=True)
+                            continue
+                    if is_before_margin(query, from_day):
+                        return
                     if query["Status"]["State"] in ["SUCCEEDED", "FAILED", "CANCELLED"]:
-                        query_day = get_query_exec_day(query)
-                        if query_day >= from_day:
+                        if get_query_exec_day(query) >= from_day:
                             yield query
-                        else:
-                            return
+                    elif watermark:
+                        watermark.observe(query, collected=False)
+                    else:
+                        # Still running, collected by a later run of its day only
+                        if counts is not None:
+                            counts["dropped"] = counts.get("dropped", 0) + 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class JsonHistoryWriter:
+    # Compresses records as they are produced and streams them to S3 in multipart parts,
+    # memory is bounded by the part size and nothing is written to local storage
+    def __init__(
+        self,
+        day: str,
+        workgroup: str,
+        s3_client=None,
+        part: str = None,
+        region: str = None,
+    ):
+        self.day = day
+        self.key = get_history_key(day, workgroup, part, region)
+        self.rows = 0
+        self.s3_file = S3MultipartWriter(get_bucket(), self.key, s3_client)
+        self.gzip_file = gzip.GzipFile(fileobj=self.s3_file, mode="wb")
+
+    def write(self, record: dict):
+        self.gzip_file.write(json.dumps(record).encode("utf-8"))
+        self.gzip_file.write(b"\n")
+        self.rows += 1
+        if self.rows % 1000 == 0:
+            logger.info(f"Day: {self.day}, Written {self.rows} rows")
+
+    def close(self):
+        self.gzip_file.close()
+        self.s3_file.close()
+        logger.info(f"Day: {self.day}, Total: {self.rows} rows")
+        logger.info(f"uploaded key: {self.key}")
+
+    def abort(self):
+        self.s3_file.abort()
+
+
+class ParquetHistoryWriter:
+    schema = [
+        ("query_id", "string"),
+        ("query", "string"),
+        ("data_scanned", "int64"),
+        ("workgroup", "string"),
+    ]
+
+    def __init__(
+        self,
+        day: str,
+        workgroup: str,
+        s3_client=None,
+        part: str = None,
+        region: str = None,
+    ):
+        self.day = day
+        self.key = get_history_key(day, workgroup, part, region)
+        self.parquet_file = S3ParquetWriter(
+            get_bucket(), self.key, self.schema, s3_client
+        )
+
+    @property
+    def rows(self) -> int:
+        return self.parquet_file.rows
+
+    def write(self, record: dict):
+        if self.parquet_file.write(record):
+            logger.info(f"Day: {self.day}, Written {self.rows} rows")
+
+    def close(self):
+        self.parquet_file.close()
+        logger.info(f"Day: {self.day}, Total: {self.rows} rows")
+        logger.info(f"uploaded key: {self.key}")
+
+    def abort(self):
+        self.parquet_file.abort()
 
 
-def upload_history_file(file_name: str, day: str, workgroup: str):
-    with tempfile.NamedTemporaryFile(mode="wb", delete=False) as f_out:
-        with (
-            open(file_name, "rb") as json_file_in,
-            gzip.open(f_out.name, "wb") as gzip_fie,
+def open_history_writer(
+    day: str, workgroup: str, s3_client=None, part: str = None, region: str = None
+):
+    if get_history_format() == "parquet":
+        return ParquetHistoryWriter(day, workgroup, s3_client, part, region)
+    return JsonHistoryWriter(day, workgroup, s3_client, part, region)
+
+
+def get_history_record(query: dict, workgroup: str) -> dict:
+    if "Statistics" in query and "DataScannedInBytes" in query["Statistics"]:
+        data_scanned = query["Statistics"]["DataScannedInBytes"]
+    else:
+        data_scanned = 0
+    return {
+        "query_id": query["QueryExecutionId"],
+        "query": query["Query"],
+        "data_scanned": data_scanned,
+        "workgroup": workgroup,
+    }
+
+
+class DayWriters:
+    # One streaming writer per day, so executions completing out of order are written
+    # to their own day. At most MAX_OPEN_DAYS days are open, the newest day is closed
+    # first as the listing goes back in time. A day written again after it was closed
+    # gets another part file, its records are counted as late.
+    # Query ids already in a day's index are skipped, a day which has an index is
+    # appended to with a part file, and the index is updated when the day is closed
+    def __init__(self, workgroup: str, s3_client, part: str = None, region: str = None):
+        self.workgroup = workgroup
+        self.s3_client = s3_client or create_client("s3")
+        self.part = part
+        self.region = region
+        self.writers = {}
+        self.query_ids = {}
+        self.indexed = set()
+        self.closed = {}
+        self.rows = 0
+        self.late = 0
+        self.duplicates = 0
+
+    def _get_query_ids(self, day: str) -> Set[str]:
+        if day not in self.query_ids:
+            if len(self.query_ids) >= get_max_open_days():
+                newest = max(self.query_ids)
+                if newest in self.writers:
+                    self._close(newest)
+                else:
+                    del self.query_ids[newest]
+            self.query_ids[day] = load_query_ids(
+                day, self.workgroup, self.s3_client, self.region
+            )
+            if len(self.query_ids[day]) > 0:
+                self.indexed.add(day)
+        return self.query_ids[day]
+
+    def write(self, day: str, record: dict):
+        query_ids = self._get_query_ids(day)
+        if record["query_id"] in query_ids:
+            self.duplicates += 1
+            return
+        query_ids.add(record["query_id"])
+        writer = self.writers.get(day)
+        if writer is None:
+            part = self.part
+            if day in self.closed:
+                part = f"{self.part or 'late'}-{self.closed[day]}"
+            elif part is None and day in self.indexed:
+                part = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+            writer = open_history_writer(
+                day, self.workgroup, self.s3_client, part, self.region
+            )
+            self.writers[day] = writer
+        if day in self.closed:
+            self.late += 1
+        writer.write(record)
+
+    def _close(self, day: str):
+        writer = self.writers.pop(day)
+        writer.close()
+        save_query_ids(
+            day, self.workgroup, self.query_ids.pop(day), self.s3_client, self.region
+        )
+        self.rows += writer.rows
+        self.closed[day] = self.closed.get(day, 0) + 1
+
+    def close(self):
+        for day in list(self.writers):
+            self._close(day)
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+        self.writers = {}
+
+
+def create_history_day_for_workgroup(
+    from_day: str,
+    to_day: str,
+    workgroup: str,
+    athena=None,
+    s3_client=None,
+    api_calls: threading.Semaphore = None,
+    watermark: Watermark = None,
+    region: str = None,
+    append: bool = False,
+    counts: Dict[str, int] = None,
+) -> int:
+    # Incremental and append runs add a new part file to the day's partition instead
+    # of data.json.gz
+    counts = {} if counts is None else counts
+    part = None
+    if watermark or append:
+        part = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    writers = DayWriters(workgroup, s3_client, part, region)
+    try:
+        for query in get_query_executions_for_workgroup(
+            workgroup, from_day, athena, api_calls, watermark, counts
         ):
-            # noinspection PyTypeChecker
-            shutil.copyfileobj(json_file_in, gzip_fie)
-        key = get_history_key(day, workgroup)
-        s3_client = boto3.client("s3")
-        s3_client.upload_file(f_out.name, get_bucket(), key)
-    logger.info(f"uploaded key: {key}")
-
-
-def create_history_day_for_workgroup(from_day: str, to_day: str, workgroup: str) -> int:
-    current_day = to_day
-    current_day_rows = 0
-    total_rows = 0
-    json_file = None
-
-    for query in get_query_executions_for_workgroup(workgroup, from_day):
-        query_day = get_query_exec_day(query)
-        if query_day < current_day or query_day < from_day:
-            if json_file:
-                json_file.close()
-                logger.info(f"Day: {current_day}, Total: {current_day_rows} rows")
-                total_rows += current_day_rows
-                current_day_rows = 0
-                upload_history_file(json_file.name, current_day, workgroup)
-                os.remove(json_file.name)
-                json_file = None
-                current_day = query_day
-        if current_day == query_day:
-            if json_file is None:
-                json_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
-            if "Statistics" in query and "DataScannedInBytes" in query["Statistics"]:
-                data_scanned = query["Statistics"]["DataScannedInBytes"]
-            else:
-                data_scanned = 0
-            record = {
-                "query_id": query["QueryExecutionId"],
-                "query": query["Query"],
-                "data_scanned": data_scanned,
-                "workgroup": workgroup,
-            }
-            json_file.write(json.dumps(record))
-            json_file.write("\n")
-            current_day_rows += 1
-            if current_day_rows % 1000 == 0:
-                logger.info(f"Day: {current_day}, Written {current_day_rows} rows")
-    if json_file:
-        logger.info(f"Day: {current_day}, Total: {current_day_rows} rows")
-        total_rows += current_day_rows
-        json_file.close()
-        upload_history_file(json_file.name, current_day, workgroup)
-    return current_day_rows
+            query_day = get_query_exec_day(query)
+            if watermark:
+                watermark.observe(query, collected=query_day <= to_day)
+            if query_day <= to_day:
+                writers.write(query_day, get_history_record(query, workgroup))
+        writers.close()
+    except Exception:
+        writers.abort()
+        raise
+    dropped = counts.get("dropped", 0)
+    if writers.late > 0 or writers.duplicates > 0 or dropped > 0:
+        logger.info(
+            f"Workgroup: {workgroup}, {writers.late} late records, "
+            f"{writers.duplicates} already collected, {dropped} still running dropped"
+        )
+    metrics.record(
+        "history.records",
+        rows=writers.rows,
+        late=writers.late,
+        duplicates=writers.duplicates,
+        dropped=dropped,
+    )
+    return writers.rows
+
+
+def create_history_regions(
+    from_day: str,
+    to_day: str,
+    regions: List[str],
+    workgroup: str = None,
+    clear: bool = False,
+    incremental: bool = False,
+    append: bool = False,
+) -> Dict[str, any]:
+    # Every region has its own Athena client and API call limit, they share the S3
+    # client. Up to REGION_WORKERS regions are collected at a time
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(regions), get_region_workers())
+    ) as region_pool:
+        futures = {
+            region: region_pool.submit(
+                create_history_days_range,
+                from_day,
+                to_day,
+                workgroup,
+                clear,
+                incremental,
+                region,
+                append,
+            )
+            for region in regions
+        }
+        results = {region: future.result() for region, future in futures.items()}
+    return {
+        "from_day": from_day,
+        "to_day": to_day,
+        "records": sum(result["records"] for result in results.values()),
+        "regions": results,
+    }
 
 
 def validate_day_range(from_day: str, to_day: str):
@@ -198,7 +716,71 @@ def validate_day_range(from_day: str, to_day: str):
         )
 
 
+def get_orchestration_units(
+    from_day: str,
+    to_day: str,
+    regions: List[str],
+    workgroup: str,
+    force: bool,
+    incremental: bool,
+    append: bool,
+) -> List[dict]:
+    # Executions are listed newest first, so a workgroup is listed back to from_day
+    # whatever its unit covers. Splitting a workgroup by day would list the newer days
+    # again for every unit, each unit covers the whole range of one workgroup instead
+    units = []
+    for region in regions:
+        if workgroup is None:
+            athena = create_client("athena", region)
+            workgroups = [w["Name"] for w in athena.list_work_groups()["WorkGroups"]]
+        else:
+            workgroups = [workgroup]
+        units += [
+            {
+                "from_day": from_day,
+                "to_day": to_day,
+                "regions": region,
+                "workgroup": w,
+                "force": force,
+                "incremental": incremental,
+                "append": append,
+            }
+            for w in workgroups
+        ]
+    return units
+
+
+def orchestrate(
+    from_day: str,
+    to_day: str,
+    regions: List[str],
+    workgroup: str,
+    force: bool,
+    incremental: bool,
+    append: bool,
+    run_id: str = None,
+    resume: dict = None,
+) -> dict:
+    units = get_orchestration_units(
+        from_day, to_day, regions, workgroup, force, incremental, append
+    )
+    state_prefix = get_run_prefix(
+        f"{get_location()}/_orchestrations/region={get_region()}", units, run_id
+    )
+    result = fan_out(lambda_handler, units, get_bucket(), state_prefix, resume)
+    return {"run_id": run_id, **result}
+
+
 def lambda_handler(event, context):
+    metrics.reset()
+    result = handle_event(event)
+    if get_telemetry():
+        metrics.emit(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "athena_history"))
+        result["telemetry"] = metrics.summary()
+    return result
+
+
+def handle_event(event: dict) -> dict:
     if "day" in event:
         from_day = event["day"]
         to_day = event["day"]
@@ -207,10 +789,45 @@ def lambda_handler(event, context):
         to_day = event.get("to_day", get_yesterday())
 
     validate_day_range(from_day, to_day)
-
-    logger.info(f"START. from day: {from_day}, to day: {to_day}")
-    result = create_history_days_range(
-        from_day, to_day, event.get("workgroup"), event.get("force", False)
-    )
+    regions = event["regions"].split(",") if "regions" in event else get_regions()
+
+    if event.get("mode") == "orchestrate":
+        logger.info(f"START orchestration. from day: {from_day}, to day: {to_day}")
+        run_id = get_run_id(event)
+        result = orchestrate(
+            from_day,
+            to_day,
+            regions,
+            event.get("workgroup"),
+            event.get("force", False),
+            event.get("incremental", False),
+            event.get("append", False),
+            run_id,
+            {**event, "run_id": run_id},
+        )
+        logger.info(result)
+        return result
+
+    logger.info(f"START. from day: {from_day}, to day: {to_day}, regions: {regions}")
+    if regions == [get_region()]:
+        result = create_history_days_range(
+            from_day,
+            to_day,
+            event.get("workgroup"),
+            event.get("force", False),
+            event.get("incremental", False),
+            append=event.get("append", False),
+        )
+    else:
+        result = create_history_regions(
+            from_day,
+            to_day,
+            regions,
+            event.get("workgroup"),
+            event.get("force", False),
+            event.get("incremental", False),
+            event.get("append", False),
+        )
+    complete_unit(event, result)
     logger.info(result)
     return result
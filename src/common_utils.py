@@ -1,12 +1,182 @@
+import codecs
+import concurrent.futures
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import threading
+import time
 from datetime import datetime, timedelta, date
-from typing import Generator
-
-import boto3
-from botocore.exceptions import ClientError
+from typing import Generator, Tuple, List, Set, Callable, Any
 
 logger = logging.getLogger()
 
+_boto3_lock = threading.Lock()
+_clients = {}
+
+THROTTLING_ERRORS = [
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "SlowDown",
+    "RequestLimitExceeded",
+]
+
+
+def get_max_pool_connections() -> int:
+    # Should cover the largest worker pool sharing a client
+    return int(os.environ.get("MAX_POOL_CONNECTIONS", "50"))
+
+
+def get_client_max_attempts() -> int:
+    return int(os.environ.get("CLIENT_MAX_ATTEMPTS", "5"))
+
+
+def get_client_config():
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=get_max_pool_connections(),
+        retries={"mode": "adaptive", "max_attempts": get_client_max_attempts()},
+        tcp_keepalive=True,
+    )
+
+
+def create_client(service_name: str, region_name: str = None):
+    # Clients are kept for the life of the execution environment, so warm invocations
+    # and worker threads share their connection pools and adaptive retry state.
+    # Creating clients from the default boto3 session is not thread safe
+    region_name = (
+        region_name
+        or os.environ.get("AWS_REGION")
+        or os.environ.get("AWS_DEFAULT_REGION")
+    )
+    key = (service_name, region_name)
+    with _boto3_lock:
+        if key not in _clients:
+            # boto3 is imported with the first client rather than at cold start
+            import boto3
+
+            client = boto3.client(
+                service_name, region_name=region_name, config=get_client_config()
+            )
+            instrument_client(client)
+            _clients[key] = client
+        return _clients[key]
+
+
+def reset_clients():
+    with _boto3_lock:
+        _clients.clear()
+
+
+def get_telemetry() -> bool:
+    return os.environ.get("TELEMETRY", "false").lower() == "true"
+
+
+def get_metrics_namespace() -> str:
+    return os.environ.get("METRICS_NAMESPACE", "AthenaAudit")
+
+
+class Metrics:
+    # Totals per operation ("s3.GetObject", "athena.query", ...) since the last reset.
+    # Values ending with _ms also keep their maximum
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, operation: str, calls: int = 1, **values: float):
+        if not get_telemetry():
+            return
+        with self.lock:
+            totals = self.operations.setdefault(operation, {"calls": 0})
+            totals["calls"] += calls
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0) + value
+                if name.endswith("_ms"):
+                    max_name = f"max_{name}"
+                    totals[max_name] = max(totals.get(max_name, 0), value)
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                operation: {name: round(value, 3) for name, value in totals.items()}
+                for operation, totals in sorted(self.operations.items())
+            }
+
+    def emit(self, function: str):
+        # CloudWatch Embedded Metric Format, one line per operation on stdout
+        timestamp = int(time.time() * 1000)
+        for operation, totals in self.summary().items():
+            print(
+                json.dumps(
+                    {
+                        "_aws": {
+                            "Timestamp": timestamp,
+                            "CloudWatchMetrics": [
+                                {
+                                    "Namespace": get_metrics_namespace(),
+                                    "Dimensions": [["Function", "Operation"]],
+                                    "Metrics": [
+                                        {
+                                            "Name": name,
+                                            "Unit": get_metric_unit(name),
+                                        }
+                                        for name in totals
+                                    ],
+                                }
+                            ],
+                        },
+                        "Function": function,
+                        "Operation": operation,
+                        **totals,
+                    }
+                )
+            )
+
+
+def get_metric_unit(name: str) -> str:
+    if name.endswith("_ms"):
+        return "Milliseconds"
+    if name.endswith("_bytes"):
+        return "Bytes"
+    return "Count"
+
+
+metrics = Metrics()
+
+
+def instrument_client(client):
+    # Every API call of the client is timed, paginator pages and S3 transfers included.
+    # Retries are counted from needs-retry, which fires once per attempt
+    service = client.meta.service_model.service_name
+
+    def before_call(context, **kwargs):
+        context["telemetry_start"] = time.perf_counter()
+
+    def after_call(parsed, model, context, **kwargs):
+        error_code = parsed.get("Error", {}).get("Code")
+        metrics.record(
+            f"{service}.{model.name}",
+            time_ms=(time.perf_counter() - context.get("telemetry_start", 0)) * 1000,
+            retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            errors=int(error_code is not None),
+        )
+
+    def needs_retry(response, operation, **kwargs):
+        if response is not None:
+            error_code = response[1].get("Error", {}).get("Code")
+            if error_code in THROTTLING_ERRORS:
+                metrics.record(f"{service}.{operation.name}", calls=0, throttles=1)
+
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("after-call", after_call)
+    client.meta.events.register("needs-retry", needs_retry)
+
 
 def get_day_back(back: int) -> str:
     return str(date.today() - timedelta(back))
@@ -26,22 +196,479 @@ def get_days(from_day: str, to_day: str) -> Generator[str, None, None]:
         date_object += timedelta(1)
 
 
-def obj_exists(bucket: str, key: str):
-    s3_client = boto3.client("s3")
+def obj_exists(bucket: str, key: str, s3_client=None):
+    s3_client = s3_client or create_client("s3")
     try:
         s3_client.head_object(Bucket=bucket, Key=key)
         return True
-    except ClientError as e:
+    except s3_client.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "404":
             return False
         else:
             raise e
 
 
+def list_objects(bucket: str, prefix: str, s3_client=None) -> List[dict]:
+    s3_client = s3_client or create_client("s3")
+    objects = []
+    for page in s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=prefix
+    ):
+        objects += page.get("Contents", [])
+    return objects
+
+
+def list_keys(bucket: str, prefix: str, s3_client=None) -> Set[str]:
+    # Existence index of all the objects under a prefix, one listing instead of a
+    # HEAD request per object
+    return {o["Key"] for o in list_objects(bucket, prefix, s3_client)}
+
+
+def split_s3_path(path: str) -> Tuple[str, str]:
+    bucket, _, key = path.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def get_read_chunk_size() -> int:
+    return int(os.environ.get("S3_READ_CHUNK_MB", "8")) * 1024 * 1024
+
+
+def iter_s3_lines(
+    bucket: str, key: str, s3_client=None, chunk_size: int = None
+) -> Generator[str, None, None]:
+    # Reads the object with ranged GETs and yields its lines (including the line
+    # break), so only one chunk is held in memory at a time. Lines are split on
+    # "\n" only, as expected by the csv module
+    s3_client = s3_client or create_client("s3")
+    chunk_size = chunk_size or get_read_chunk_size()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    position = 0
+    size = None
+    pending = ""
+    while size is None or position < size:
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket,
+                Key=key,
+                Range=f"bytes={position}-{position + chunk_size - 1}",
+            )
+        except s3_client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidRange":
+                return
+            raise e
+        size = int(response["ContentRange"].split("/")[-1])
+        data = response["Body"].read()
+        position += len(data)
+        pending += decoder.decode(data, final=position >= size)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if pending:
+        yield pending
+
+
 def clear_folder(bucket: str, s3_folder: str) -> int:
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(bucket)
-    res = bucket.objects.filter(Prefix=s3_folder).delete()
-    deleted = 0 if len(res) == 0 else len(res[0]["Deleted"])
+    s3_client = create_client("s3")
+    keys = [o["Key"] for o in list_objects(bucket, s3_folder, s3_client)]
+    deleted = delete_objects(bucket, keys, s3_client)
     logger.info(f"{deleted} objects deleted from under {s3_folder}")
     return deleted
+
+
+def get_delete_workers() -> int:
+    return int(os.environ.get("S3_DELETE_WORKERS", "8"))
+
+
+def delete_objects_batch(bucket: str, keys: List[str], s3_client) -> int:
+    response = s3_client.delete_objects(
+        Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+    )
+    errors = response.get("Errors", [])
+    for error in errors:
+        logger.warning(f"Failed deleting {error['Key']}: {error['Message']}")
+    return len(keys) - len(errors)
+
+
+def delete_objects(bucket: str, keys: List[str], s3_client=None) -> int:
+    # Deletes in batches of 1000 keys (the delete_objects limit), in parallel
+    s3_client = s3_client or create_client("s3")
+    batches = [keys[i : i + 1000] for i in range(0, len(keys), 1000)]
+    if len(batches) <= 1:
+        return sum(delete_objects_batch(bucket, b, s3_client) for b in batches)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_delete_workers()
+    ) as delete_pool:
+        return sum(
+            delete_pool.map(
+                lambda batch: delete_objects_batch(bucket, batch, s3_client), batches
+            )
+        )
+
+
+def get_history_format() -> str:
+    history_format = os.environ.get("HISTORY_FORMAT", "json").lower()
+    if history_format not in ["json", "parquet"]:
+        raise ValueError(f"Unsupported history format: {history_format}")
+    return history_format
+
+
+def get_upload_part_size() -> int:
+    # S3 requires at least 5 MB for every part except the last one
+    return max(5, int(os.environ.get("UPLOAD_PART_SIZE_MB", "8"))) * 1024 * 1024
+
+
+class S3MultipartWriter:
+    # Binary file-like object which uploads its content as S3 multipart parts whenever
+    # the buffer fills up. Small objects are written with a single put_object call
+    def __init__(self, bucket: str, key: str, s3_client=None, part_size: int = None):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client or create_client("s3")
+        self.part_size = part_size or get_upload_part_size()
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self._buffer.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+                )
+            else:
+                if len(self._buffer) > 0:
+                    self._upload_part()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts},
+                )
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self._buffer.clear()
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+            self._upload_id = None
+        self.closed = True
+        self._buffer.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def get_parquet_row_group_size() -> int:
+    return int(os.environ.get("PARQUET_ROW_GROUP_SIZE", "100000"))
+
+
+def get_parquet_compression() -> str:
+    return os.environ.get("PARQUET_COMPRESSION", "zstd")
+
+
+class S3ParquetWriter:
+    # Buffers one row group at a time and streams the parquet file to S3. pyarrow is not
+    # part of the Lambda runtime, it has to be provided by a layer to use this writer
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        schema: List[Tuple[str, str]],
+        s3_client=None,
+        row_group_size: int = None,
+    ):
+        import pyarrow
+        import pyarrow.parquet
+
+        types = {
+            "string": pyarrow.string(),
+            "int64": pyarrow.int64(),
+            "timestamp": pyarrow.timestamp("ms"),
+        }
+        self.pa = pyarrow
+        self.columns = [name for name, _ in schema]
+        self.schema = pyarrow.schema([(name, types[t]) for name, t in schema])
+        self.rows = 0
+        self.row_group_size = row_group_size or get_parquet_row_group_size()
+        self.row_group = {column: [] for column in self.columns}
+        self.s3_file = S3MultipartWriter(bucket, key, s3_client)
+        self.parquet_file = pyarrow.parquet.ParquetWriter(
+            self.s3_file,
+            self.schema,
+            compression=get_parquet_compression(),
+            use_dictionary=True,
+            write_statistics=True,
+        )
+
+    def write(self, record: dict) -> bool:
+        # Returns True when a row group was written
+        for column in self.columns:
+            self.row_group[column].append(record[column])
+        self.rows += 1
+        if len(self.row_group[self.columns[0]]) >= self.row_group_size:
+            self._write_row_group()
+            return True
+        return False
+
+    def _write_row_group(self):
+        if len(self.row_group[self.columns[0]]) > 0:
+            table = self.pa.Table.from_pydict(self.row_group, schema=self.schema)
+            self.parquet_file.write_table(table)
+            self.row_group = {column: [] for column in self.columns}
+
+    def close(self):
+        self._write_row_group()
+        self.parquet_file.close()
+        self.s3_file.close()
+
+    def abort(self):
+        self.s3_file.abort()
+
+
+class AdaptiveWindow:
+    # Additive increase while latency stays close to its moving average, multiplicative
+    # decrease on throttling or when latency degrades
+    def __init__(self, max_size: int, initial_size: int = 3):
+        self.max_size = max(1, max_size)
+        self.size = min(max(1, initial_size), self.max_size)
+        self.latency = None
+        self._lock = threading.Lock()
+
+    def on_success(self, seconds: float):
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            elif seconds > 2 * self.latency:
+                self.size = max(1, self.size - 1)
+            elif seconds <= 1.5 * self.latency:
+                self.size = min(self.max_size, self.size + 1)
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def on_throttle(self):
+        with self._lock:
+            self.size = max(1, self.size // 2)
+
+
+def get_fan_out_workers() -> int:
+    return int(os.environ.get("FAN_OUT_WORKERS", "8"))
+
+
+def get_unit_key(state_prefix: str, unit: dict) -> str:
+    digest = hashlib.sha256(json.dumps(unit, sort_keys=True).encode()).hexdigest()
+    return f"{state_prefix}/{digest[:16]}.json"
+
+
+def get_dispatch_timeout_minutes() -> int:
+    # Units dispatched more recently may still be running and are not dispatched again
+    return int(os.environ.get("FAN_OUT_DISPATCH_TIMEOUT_MINUTES", "30"))
+
+
+def get_dispatch_key(state_prefix: str, unit: dict) -> str:
+    digest = hashlib.sha256(json.dumps(unit, sort_keys=True).encode()).hexdigest()
+    return f"{state_prefix}/_dispatched/{digest[:16]}.json"
+
+
+def get_run_id(event: dict) -> str:
+    # A forced orchestration starts a new run instead of finding the completed one, the
+    # units it dispatches resume it with the same id
+    if event.get("run_id"):
+        return event["run_id"]
+    if event.get("force", False):
+        return datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    return None
+
+
+def get_run_prefix(folder: str, units: List[dict], run_id: str = None) -> str:
+    # The same range and options always map to the same run, so running it again
+    # resumes the units which did not complete
+    run = units if run_id is None else {"run_id": run_id, "units": units}
+    digest = hashlib.sha256(json.dumps(run, sort_keys=True).encode()).hexdigest()
+    return f"{folder}/{digest[:16]}"
+
+
+def invoke_function(function_name: str, event: dict):
+    create_client("lambda").invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps(event).encode(),
+    )
+
+
+def complete_unit(event: dict, result: dict):
+    # Each unit records its own completion, the orchestrator never waits for it. While
+    # units are queued, a completed unit runs the orchestration again to dispatch them
+    if "orchestration" not in event:
+        return
+    unit = {k: v for k, v in event.items() if k != "orchestration"}
+    create_client("s3").put_object(
+        Bucket=event["orchestration"]["bucket"],
+        Key=event["orchestration"]["key"],
+        Body=json.dumps({"unit": unit, "result": result}, default=str).encode(),
+    )
+    if "resume" in event["orchestration"]:
+        invoke_function(
+            os.environ["AWS_LAMBDA_FUNCTION_NAME"], event["orchestration"]["resume"]
+        )
+
+
+def release_unit(event: dict):
+    # A unit which ended without completing can be dispatched again right away
+    if "dispatch_key" not in event.get("orchestration", {}):
+        return
+    create_client("s3").delete_object(
+        Bucket=event["orchestration"]["bucket"],
+        Key=event["orchestration"]["dispatch_key"],
+    )
+
+
+def claim_unit(s3_client, bucket: str, dispatch_key: str, unit: dict, expired: dict):
+    # Conditional writes let only one of several concurrent orchestrations dispatch a
+    # unit. An expired dispatch is replaced only if no one replaced it first
+    condition = {"IfMatch": expired["ETag"]} if expired else {"IfNoneMatch": "*"}
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=dispatch_key,
+            Body=json.dumps(
+                {"unit": unit, "dispatched": datetime.now().isoformat()}
+            ).encode(),
+            **condition,
+        )
+    except s3_client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in [
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ]:
+            return False
+        raise
+    return True
+
+
+def fan_out(
+    handler: Callable[[dict, Any], dict],
+    units: List[dict],
+    bucket: str,
+    state_prefix: str,
+    resume: dict = None,
+) -> dict:
+    # Inside Lambda every pending unit is an asynchronous invocation of the same function
+    # with its own time budget, at most FAN_OUT_WORKERS of them running at once. The
+    # rest are queued until a unit completes and invokes resume, the orchestration
+    # event, or until the orchestration runs again. Elsewhere the units run in a local
+    # process pool
+    s3_client = create_client("s3")
+    state = {o["Key"]: o for o in list_objects(bucket, f"{state_prefix}/", s3_client)}
+    dispatched_after = time.time() - get_dispatch_timeout_minutes() * 60
+    pending = []
+    in_progress = 0
+    for unit in units:
+        key = get_unit_key(state_prefix, unit)
+        if key in state:
+            continue
+        dispatched = state.get(get_dispatch_key(state_prefix, unit))
+        if dispatched and dispatched["LastModified"].timestamp() > dispatched_after:
+            in_progress += 1
+            continue
+        pending.append({**unit, "orchestration": {"bucket": bucket, "key": key}})
+    completed = len(units) - len(pending) - in_progress
+    failed = []
+    queued = []
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+    if function_name:
+        slots = max(0, get_fan_out_workers() - in_progress)
+        pending, queued = pending[:slots], pending[slots:]
+    logger.info(
+        f"{completed} of {len(units)} units already completed and {in_progress} in "
+        f"progress under {state_prefix}, dispatching {len(pending)}, "
+        f"queued {len(queued)}"
+    )
+    if function_name:
+        dispatched = []
+        for unit in pending:
+            unit_key = {k: v for k, v in unit.items() if k != "orchestration"}
+            dispatch_key = get_dispatch_key(state_prefix, unit_key)
+            if not claim_unit(
+                s3_client, bucket, dispatch_key, unit_key, state.get(dispatch_key)
+            ):
+                in_progress += 1
+                continue
+            unit["orchestration"]["dispatch_key"] = dispatch_key
+            if resume is not None and len(queued) > 0:
+                unit["orchestration"]["resume"] = resume
+            invoke_function(function_name, unit)
+            dispatched.append(unit)
+        pending = dispatched
+    else:
+        # Forked workers would inherit the client registry and its connections, the
+        # workers are started fresh instead
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=get_fan_out_workers(),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = {pool.submit(handler, unit, None): unit for unit in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    unit = {
+                        k: v for k, v in futures[future].items() if k != "orchestration"
+                    }
+                    logger.warning(f"Unit {unit} failed: {e}")
+                    failed.append({**unit, "error": str(e)})
+    return {
+        "state": f"s3://{bucket}/{state_prefix}/",
+        "units": len(units),
+        "completed": completed,
+        "in_progress": in_progress,
+        "dispatched": len(pending),
+        "queued": len(queued),
+        "failed": failed,
+    }
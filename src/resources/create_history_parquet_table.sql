@@ -0,0 +1,16 @@
+CREATE EXTERNAL TABLE {table}(
+  query_id string,
+  query string,
+  data_scanned bigint,
+  workgroup string)
+PARTITIONED BY (
+  region string,
+  day string)
+ROW FORMAT SERDE
+  'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+STORED AS INPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat'
+OUTPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
+LOCATION
+  's3://{bucket}/{prefix}'
\ No newline at end of file
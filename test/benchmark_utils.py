@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+# Shared by the *_benchmark.py suites, which run offline against moto and synthetic
+# data. Results are compared to resources/benchmark_baseline.json, run with
+# BENCHMARK_UPDATE_BASELINE=true to record a new baseline. The baseline holds numbers
+# of one machine, BENCHMARK_CHECK=false only reports the results (as done in CI)
+
+BASELINE_FILE = Path(__file__).parent / "resources" / "benchmark_baseline.json"
+
+
+def get_benchmark_queries() -> int:
+    return int(os.environ.get("BENCHMARK_QUERIES", "10000"))
+
+
+def get_benchmark_workgroups() -> int:
+    return int(os.environ.get("BENCHMARK_WORKGROUPS", "4"))
+
+
+def get_benchmark_days() -> int:
+    return int(os.environ.get("BENCHMARK_DAYS", "3"))
+
+
+def get_benchmark_tolerance() -> float:
+    return float(os.environ.get("BENCHMARK_TOLERANCE", "0.5"))
+
+
+def get_benchmark_check() -> bool:
+    return os.environ.get("BENCHMARK_CHECK", "true").lower() == "true"
+
+
+def get_update_baseline() -> bool:
+    return os.environ.get("BENCHMARK_UPDATE_BASELINE", "false").lower() == "true"
+
+
+def _tmp_bytes() -> int:
+    total = 0
+    for entry in os.scandir(tempfile.gettempdir()):
+        try:
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def _rss_bytes() -> int | None:
+    # The current RSS, the peak RSS of the process would include earlier benchmarks.
+    # Only available on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def run_benchmark(name: str, run: Callable[[], int]) -> dict:
+    start_tmp = _tmp_bytes()
+    peak_tmp = start_tmp
+    peak_rss = _rss_bytes()
+    stop = threading.Event()
+
+    def sample_tmp():
+        nonlocal peak_tmp, peak_rss
+        while not stop.wait(0.05):
+            peak_tmp = max(peak_tmp, _tmp_bytes())
+            rss = _rss_bytes()
+            if rss is not None:
+                peak_rss = max(peak_rss, rss)
+
+    sampler = threading.Thread(target=sample_tmp)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        records = run()
+    finally:
+        seconds = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        rss = _rss_bytes()
+        if rss is not None:
+            peak_rss = max(peak_rss, rss)
+    result = {
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_sec": round(records / seconds),
+        "peak_rss_mb": (
+            round(peak_rss / 1024 / 1024) if peak_rss is not None else None
+        ),
+        "tmp_bytes": peak_tmp - start_tmp,
+    }
+    print(json.dumps({name: result}))
+    check_baseline(
+        f"{name}[{get_benchmark_workgroups()}x{get_benchmark_queries()}"
+        f"x{get_benchmark_days()}]",
+        result,
+    )
+    return result
+
+
+def check_baseline(key: str, result: dict):
+    baseline = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+    if get_update_baseline():
+        baseline[key] = {
+            "records_per_sec": result["records_per_sec"],
+            "tmp_bytes": result["tmp_bytes"],
+        }
+        BASELINE_FILE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        return
+    if key not in baseline or not get_benchmark_check():
+        return
+    expected = baseline[key]["records_per_sec"] * (1 - get_benchmark_tolerance())
+    assert (
+        result["records_per_sec"] >= expected
+    ), f"{key}: {result['records_per_sec']} records/sec, baseline {baseline[key]}"
+    assert (
+        result["tmp_bytes"] <= baseline[key]["tmp_bytes"] + 1024 * 1024
+    ), f"{key}: {result['tmp_bytes']} bytes in /tmp, baseline {baseline[key]}"
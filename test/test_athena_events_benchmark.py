@@ -0,0 +1,107 @@
+import gzip
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from athena_events import (
+    extract_athena_events,
+    insert_data_local,
+    get_cloud_trail_location,
+    get_history_location,
+)
+from benchmark_utils import get_benchmark_queries, run_benchmark
+
+# Throughput of the events ingest over synthetic CloudTrail and history objects
+
+DAY = "2024-03-01"
+REGION = "us-east-1"
+EVENTS_PER_OBJECT = 500
+
+
+def _cloud_trail_event(index: int) -> dict:
+    return {
+        "eventVersion": "1.08",
+        "userIdentity": {
+            "type": "IAMUser",
+            "principalId": f"USER{index % 100}",
+            "arn": f"arn:aws:iam::123456789:user/user-{index % 100}",
+        },
+        "eventTime": "2024-03-01T08:30:14Z",
+        "eventSource": "athena.amazonaws.com",
+        "eventName": "StartQueryExecution" if index % 10 else "GetQueryExecution",
+        "awsRegion": REGION,
+        "sourceIPAddress": "1.1.1.1",
+        "userAgent": "Boto3/1.26.82 Python/3.8.16 Linux/4.9.0-7-amd64",
+        "requestParameters": {
+            "queryString": f"SELECT * FROM events WHERE user_id = {index}",
+            "queryExecutionContext": {"database": "default"},
+            "workGroup": f"workgroup-{index % 4}",
+        },
+        "responseElements": {"queryExecutionId": f"query-{index}"},
+    }
+
+
+@pytest.fixture(autouse=True)
+def s3_data(monkeypatch):
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+    monkeypatch.setenv("AWS_REGION", REGION)
+    monkeypatch.setenv("TELEMETRY", "false")
+    monkeypatch.setattr(
+        "athena_events.run_query", lambda query, cache=True: {"status": "SUCCEEDED"}
+    )
+    mock = mock_aws()
+    mock.start()
+    s3 = boto3.client("s3")
+    bucket = os.environ["BUCKET"]
+    s3.create_bucket(Bucket=bucket)
+    events = get_benchmark_queries()
+    for start in range(0, events, EVENTS_PER_OBJECT):
+        records = [
+            _cloud_trail_event(i)
+            for i in range(start, min(start + EVENTS_PER_OBJECT, events))
+        ]
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{get_cloud_trail_location(REGION, DAY)}/{start}.json.gz",
+            Body=gzip.compress(json.dumps({"Records": records}).encode()),
+        )
+    history = b"".join(
+        json.dumps(
+            {"query_id": f"query-{i}", "query": f"SELECT {i}", "data_scanned": i}
+        ).encode()
+        + b"\n"
+        for i in range(events)
+    )
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{get_history_location(REGION, DAY)}/workgroup=w/data.json.gz",
+        Body=gzip.compress(history),
+    )
+    yield
+    mock.stop()
+
+
+def _athena_events() -> int:
+    return len([i for i in range(get_benchmark_queries()) if i % 10])
+
+
+def test_benchmark_extract_athena_events():
+    pytest.importorskip("pyarrow")
+    result = run_benchmark("events_extract", lambda: extract_athena_events(REGION, DAY))
+    assert result["records"] == _athena_events()
+
+
+@pytest.mark.parametrize("max_memory_mb", ["256", "0"])
+def test_benchmark_events_local_engine(monkeypatch, max_memory_mb):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setenv("LOCAL_JOIN_MAX_MEMORY_MB", max_memory_mb)
+    spill = "spill" if max_memory_mb == "0" else "memory"
+    result = run_benchmark(
+        f"events_local_engine_{spill}",
+        lambda: insert_data_local(DAY, REGION, add_partition=False)["rows"],
+    )
+    assert result["records"] == _athena_events()
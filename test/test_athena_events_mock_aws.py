@@ -0,0 +1,425 @@
+import gzip
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from athena_events import (
+    lambda_handler,
+    TableType,
+    run_queries,
+    run_query,
+    get_events_sort_by,
+    get_source_table_types,
+    insert_data,
+    get_query_results,
+    init_database,
+    tables_exist,
+)
+
+
+def get_file_resource(file_name: str) -> str:
+    abs_path = str(Path(os.path.dirname(os.path.abspath(__file__))).absolute())
+    return os.path.join(abs_path, "resources", file_name)
+
+
+# batch_get_query_execution is not implemented in moto
+def _get_query_executions_data(athena_client, ids: List[str]) -> dict:
+    result = []
+    for query_id in ids:
+        result.append(
+            athena_client.get_query_execution(QueryExecutionId=query_id)[
+                "QueryExecution"
+            ]
+        )
+    return {"QueryExecutions": result}
+
+
+@pytest.fixture(autouse=True)
+def athena_mock(monkeypatch):
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("REGIONS", "us-east-1,eu-west-1,eu-central-1")
+    monkeypatch.setattr(
+        "athena_events.get_query_executions_data", _get_query_executions_data
+    )
+    mock = mock_aws()
+    mock.start()
+    boto3.client("s3").create_bucket(Bucket=os.environ["BUCKET"])
+    yield
+    mock.stop()
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    # Moto does not execute queries, the SQL statements are recorded and succeed
+    executed = []
+
+    def _run_query(query: str, cache: bool = True) -> dict:
+        executed.append(query)
+        if "region = 'eu-central-1'" in query and "INSERT INTO" in query:
+            return {"execution_id": "1", "status": "FAILED", "error": "failed"}
+        return {"execution_id": "1", "status": "SUCCEEDED"}
+
+    monkeypatch.setattr("athena_events.run_query", _run_query)
+    monkeypatch.setattr(
+        "athena_events.get_query_results",
+        lambda query, **kwargs: iter([{"events": "0"}]),
+    )
+    return executed
+
+
+def test_partitions_processed_concurrently(monkeypatch, queries):
+    monkeypatch.setenv("MAX_CONCURRENT_QUERIES", "4")
+    s3 = boto3.client("s3")
+    s3.put_object(
+        Bucket=os.environ["BUCKET"],
+        Key=f"{TableType.EVENTS.folder}/region=eu-west-1/day=2024-03-02/old.parquet",
+        Body=b"",
+    )
+    result = lambda_handler({"from_day": "2024-03-01", "to_day": "2024-03-02"}, None)
+    partitions = result["partitions"]
+    assert len(partitions) == 6
+    assert {(p["day"], p["region"]) for p in partitions} == {
+        (day, region)
+        for day in ["2024-03-01", "2024-03-02"]
+        for region in ["us-east-1", "eu-west-1", "eu-central-1"]
+    }
+    failed = [p for p in partitions if p["status"] != "SUCCEEDED"]
+    assert {p["region"] for p in failed} == {"eu-central-1"}
+    assert failed[0]["error"] == "failed"
+    assert len([q for q in queries if q.startswith("\nINSERT INTO")]) == 6
+    # Partitions are added up front, not by every insert
+    assert len([q for q in queries if q.startswith("ALTER TABLE")]) == 0
+    keys = [
+        o["Key"] for o in s3.list_objects_v2(Bucket=os.environ["BUCKET"])["Contents"]
+    ]
+    assert not any(key.endswith("old.parquet") for key in keys)
+    assert len([key for key in keys if "/_manifests/" in key]) == 4
+
+
+def test_run_queries(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENT_QUERIES", "2")
+    results = list(run_queries([f"SELECT {i}" for i in range(5)]))
+    assert sorted(index for index, _ in results) == [0, 1, 2, 3, 4]
+    assert all(result["status"] == "SUCCEEDED" for _, result in results)
+    assert len({result["execution_id"] for _, result in results}) == 5
+
+
+def test_run_query():
+    result = run_query("SELECT 1")
+    assert result["status"] == "SUCCEEDED"
+    assert "data_scanned_mb" in result
+
+
+def test_partition_projection(monkeypatch, queries):
+    monkeypatch.setenv("PARTITION_PROJECTION", "true")
+    monkeypatch.setattr("athena_events.tables_exist", lambda tables: False)
+    result = lambda_handler({"day": "2024-03-01", "regions": "us-east-1"}, None)
+    assert result["partitions"][0]["status"] == "SUCCEEDED"
+    created = [q for q in queries if q.startswith("CREATE EXTERNAL TABLE")]
+    assert len(created) == 3
+    assert all("'projection.enabled'='true'" in q for q in created)
+    assert len([q for q in queries if q.startswith("ALTER TABLE")]) == 0
+
+
+def test_get_query_results_from_s3_output(monkeypatch):
+    key = "athena_audit/query_results/1.csv"
+    boto3.client("s3").put_object(
+        Bucket=os.environ["BUCKET"],
+        Key=key,
+        Body=b'"col","query","n"\n"1","SELECT\n 1",\n"2","",\n',
+    )
+    monkeypatch.setattr(
+        "athena_events.run_query",
+        lambda query, cache=True: {
+            "execution_id": "1",
+            "status": "SUCCEEDED",
+            "output_location": f"s3://{os.environ['BUCKET']}/{key}",
+        },
+    )
+    assert list(get_query_results("SELECT")) == [
+        {"col": "1", "query": "SELECT\n 1", "n": None},
+        {"col": "2", "query": "", "n": None},
+    ]
+    assert list(get_query_results("SELECT", as_tuples=True)) == [
+        ("1", "SELECT\n 1", None),
+        ("2", "", None),
+    ]
+    monkeypatch.setattr(
+        "athena_events.get_column_converters", lambda execution_id: [int, str, int]
+    )
+    assert list(get_query_results("SELECT", as_tuples=True, typed=True)) == [
+        (1, "SELECT\n 1", None),
+        (2, "", None),
+    ]
+
+
+def test_query_result_cache(monkeypatch):
+    monkeypatch.setenv("QUERY_CACHE_MAX_AGE_MINUTES", "10")
+    first = run_query("SELECT 1 FROM t WHERE c = 'a  b'")
+    bucket, key = first["output_location"].removeprefix("s3://").split("/", 1)
+    boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=b'"_col0"\n"1"\n')
+    assert run_query("select 1\n  FROM t WHERE c = 'a  b';") == first
+    assert run_query("SELECT 1 FROM t WHERE c = 'a b'") != first
+    assert run_query("SELECT 1 FROM t WHERE c = 'a  b'", cache=False) != first
+    insert = "INSERT INTO t SELECT 1"
+    assert run_query(insert) != run_query(insert)
+    # Cached entries are dropped once the result file is gone
+    boto3.client("s3").delete_object(Bucket=bucket, Key=key)
+    assert run_query("SELECT 1 FROM t WHERE c = 'a  b'") != first
+
+
+def test_tables_exist_is_not_cached(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        "athena_events.run_query",
+        lambda query, cache=True: calls.append(cache) or {"status": "SUCCEEDED"},
+    )
+    assert tables_exist([TableType.EVENTS.table_name])
+    assert calls == [False]
+
+
+def test_unchanged_partitions_are_skipped(queries):
+    event = {"from_day": "2024-03-01", "to_day": "2024-03-02"}
+
+    def _statuses(result: dict) -> dict:
+        return {(p["day"], p["region"]): p["status"] for p in result["partitions"]}
+
+    statuses = _statuses(lambda_handler(event, None))
+    assert list(statuses.values()).count("SUCCEEDED") == 4
+    statuses = _statuses(lambda_handler(event, None))
+    assert list(statuses.values()).count("SKIPPED") == 4
+    assert statuses[("2024-03-01", "eu-central-1")] == "FAILED"
+
+    boto3.client("s3").put_object(
+        Bucket=os.environ["BUCKET"],
+        Key=f"{TableType.CLOUD_TRAIL.folder}/us-east-1/2024/03/01/new.json.gz",
+        Body=b"{}",
+    )
+    statuses = _statuses(lambda_handler(event, None))
+    assert statuses[("2024-03-01", "us-east-1")] == "SUCCEEDED"
+    assert list(statuses.values()).count("SKIPPED") == 3
+
+    statuses = _statuses(lambda_handler({**event, "force": True}, None))
+    assert "SKIPPED" not in statuses.values()
+
+
+def test_compaction(monkeypatch, queries):
+    s3 = boto3.client("s3")
+    bucket = os.environ["BUCKET"]
+    events = f"{TableType.EVENTS.folder}/region=us-east-1/day=2024-03-01"
+    for i in range(5):
+        s3.put_object(Bucket=bucket, Key=f"{events}/file-{i}", Body=b"0" * 100)
+
+    def _run_query(query: str, cache: bool = True) -> dict:
+        queries.append(query)
+        if query.startswith("CREATE TABLE"):
+            location = query.split("external_location = '")[1].split("'")[0]
+            s3.put_object(
+                Bucket=bucket, Key=f"{location.split('/', 3)[3]}compacted", Body=b"0"
+            )
+        return {"execution_id": "1", "status": "SUCCEEDED"}
+
+    monkeypatch.setattr("athena_events.run_query", _run_query)
+    result = lambda_handler(
+        {"day": "2024-03-01", "regions": "us-east-1,eu-west-1", "mode": "compact"},
+        None,
+    )
+    statuses = {p["region"]: p for p in result["partitions"]}
+    assert statuses["eu-west-1"]["status"] == "SKIPPED"
+    assert statuses["us-east-1"]["status"] == "SUCCEEDED"
+    assert statuses["us-east-1"]["objects"] == 5
+    assert statuses["us-east-1"]["compacted_objects"] == 1
+    assert "bucket_count = 1" in [q for q in queries if q.startswith("CREATE")][0]
+    swap = [q for q in queries if "SET LOCATION" in q][0]
+    assert "/_compacted/region=us-east-1/day=2024-03-01/" in swap
+    keys = [
+        o["Key"]
+        for o in s3.list_objects_v2(Bucket=bucket)["Contents"]
+        if "/_schema/" not in o["Key"]
+    ]
+    assert len(keys) == 1 and keys[0].endswith("/compacted")
+
+    # Rebuilding the partition moves it back to its default location
+    queries.clear()
+    lambda_handler({"day": "2024-03-01", "regions": "us-east-1"}, None)
+    assert (
+        f"SET LOCATION 's3://{bucket}/{events}/'"
+        in [q for q in queries if "SET LOCATION" in q][0]
+    )
+    assert not any(
+        "_compacted" in o["Key"]
+        for o in s3.list_objects_v2(Bucket=bucket).get("Contents", [])
+    )
+
+
+def test_cloud_trail_extract(monkeypatch, queries):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    import pyarrow
+
+    monkeypatch.setenv("CLOUD_TRAIL_EXTRACT", "true")
+    s3 = boto3.client("s3")
+    bucket = os.environ["BUCKET"]
+    with open(get_file_resource("example_event.json"), "rb") as f:
+        event = f.read()
+    cloud_trail = f"{TableType.CLOUD_TRAIL.folder}/us-east-1/2024/03/01"
+    s3.put_object(
+        Bucket=bucket, Key=f"{cloud_trail}/1.json.gz", Body=gzip.compress(event)
+    )
+    s3.put_object(Bucket=bucket, Key=f"{cloud_trail}/2.json", Body=event)
+    other = json.dumps({"Records": [{"eventSource": "s3.amazonaws.com"}]})
+    s3.put_object(Bucket=bucket, Key=f"{cloud_trail}/3.json", Body=other.encode())
+
+    result = lambda_handler({"day": "2024-03-01", "regions": "us-east-1"}, None)
+    assert result["partitions"][0]["extracted"] == 2
+    key = (
+        f"{TableType.CLOUD_TRAIL_ATHENA.folder}/region=us-east-1/day=2024-03-01/"
+        "data.parquet"
+    )
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    records = parquet.read_table(pyarrow.BufferReader(body)).to_pylist()
+    assert len(records) == 2
+    assert records[0] == {
+        "query_id": "cc405a40-434f-41f7-9f20-9a06edd85b45",
+        "event_time": datetime(2023, 5, 28, 8, 30, 14),
+        "user_identity_type": "IAMUser",
+        "user_identity_principal": "SOME_USER",
+        "user_identity_arn": "arn:aws:iam::123456789:user/some-user-name",
+        "user_agent": "Boto3/1.26.82 Python/3.8.16 Linux/4.9.0-7-amd64 Botocore/1.29.82",
+        "source_ip": "1.1.1.1",
+        "database": "default",
+        "workgroup": "some-workgroup",
+    }
+    insert = [q for q in queries if q.startswith("\nINSERT INTO")][0]
+    assert f"FROM {TableType.CLOUD_TRAIL_ATHENA.table_name} AS ct" in insert
+
+
+def test_sorted_events(monkeypatch, queries):
+    monkeypatch.setenv("EVENTS_SORT_BY", "user_identity_arn,workgroup")
+    monkeypatch.setenv("EVENTS_BUCKET_COUNT", "4")
+    result = lambda_handler({"day": "2024-03-01", "regions": "us-east-1"}, None)
+    assert result["partitions"][0]["status"] == "SUCCEEDED"
+    assert not any(q.startswith("\nINSERT INTO") for q in queries)
+    ctas = [q for q in queries if q.startswith("CREATE TABLE")][0]
+    assert "bucketed_by = ARRAY['user_identity_arn'], bucket_count = 4" in ctas
+    assert "ORDER BY" not in ctas
+    assert (
+        f"external_location = 's3://{os.environ['BUCKET']}/"
+        f"{TableType.EVENTS.folder}/region=us-east-1/day=2024-03-01/'" in ctas
+    )
+    assert any(q.startswith("DROP TABLE IF EXISTS") for q in queries)
+    # The CTAS does not add the partition of the events it writes
+    assert TableType.EVENTS in get_source_table_types()
+    queries.clear()
+    insert_data("2024-03-01", "us-east-1")
+    assert (
+        f"ALTER TABLE {TableType.EVENTS.table_name} ADD IF NOT EXISTS "
+        "PARTITION (region='us-east-1', day='2024-03-01')" in queries
+    )
+
+    monkeypatch.setenv("EVENTS_SORT_BY", "unknown")
+    with pytest.raises(ValueError):
+        get_events_sort_by()
+
+
+@pytest.mark.parametrize(
+    "max_memory_mb,sort_by",
+    [("64", ""), ("0", ""), ("64", "user_identity_arn"), ("0", "user_identity_arn")],
+)
+def test_local_engine(monkeypatch, queries, max_memory_mb, sort_by):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    import pyarrow
+
+    monkeypatch.setenv("LOCAL_JOIN_MAX_MEMORY_MB", max_memory_mb)
+    monkeypatch.setenv("EVENTS_SORT_BY", sort_by)
+    s3 = boto3.client("s3")
+    bucket = os.environ["BUCKET"]
+    with open(get_file_resource("example_event.json"), "rb") as f:
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{TableType.CLOUD_TRAIL.folder}/us-east-1/2024/03/01/1.json.gz",
+            Body=gzip.compress(f.read()),
+        )
+    with open(get_file_resource("athena_history_example.jsonl"), "rb") as f:
+        history = f.read()
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{TableType.HISTORY.folder}/region=us-east-1/day=2024-03-01/workgroup=w/data.json.gz",
+        Body=gzip.compress(
+            history + b'{"query_id": "other", "query": "SELECT 2", "data_scanned": 1}\n'
+        ),
+    )
+
+    result = lambda_handler(
+        {"day": "2024-03-01", "regions": "us-east-1", "engine": "local"}, None
+    )
+    assert result["partitions"][0]["status"] == "SUCCEEDED"
+    assert not any(q.startswith("\nINSERT INTO") for q in queries)
+    key = f"{TableType.EVENTS.folder}/region=us-east-1/day=2024-03-01/events.parquet"
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    rows = parquet.read_table(pyarrow.BufferReader(body)).to_pylist()
+    assert len(rows) == 1
+    assert rows[0]["query_id"] == "cc405a40-434f-41f7-9f20-9a06edd85b45"
+    assert rows[0]["query"] == "SELECT 1"
+    assert rows[0]["data_scanned"] == 100
+    assert rows[0]["user_identity_principal"] == "SOME_USER"
+    assert str(rows[0]["event_time"]) == "2023-05-28 08:30:14"
+
+
+def test_init_database_skipped_once_schema_marker_exists(monkeypatch, queries):
+    checks = []
+    monkeypatch.setattr(
+        "athena_events.tables_exist", lambda tables: checks.append(tables) or False
+    )
+    monkeypatch.setattr("athena_events._initialized_schemas", set())
+    # Moto does not run the CREATE statements, the tables are added to the catalog here
+    glue = boto3.client("glue")
+    glue.create_database(DatabaseInput={"Name": "default"})
+    for table_type in TableType:
+        glue.create_table(
+            DatabaseName="default",
+            TableInput={"Name": table_type.table_name.split(".")[1]},
+        )
+    assert init_database(1)
+    assert len(checks) == 1
+    # A warm invocation and a cold one (marker in S3) skip the tables check
+    assert not init_database(1)
+    monkeypatch.setattr("athena_events._initialized_schemas", set())
+    assert not init_database(1)
+    assert len(checks) == 1
+    # A table dropped since is noticed and created again
+    glue.delete_table(DatabaseName="default", Name="events")
+    assert init_database(1)
+    assert len(checks) == 2
+    glue.create_table(DatabaseName="default", TableInput={"Name": "events"})
+    # A different table definition is checked again
+    monkeypatch.setenv("PARTITION_PROJECTION", "true")
+    assert init_database(1)
+    assert len(checks) == 3
+
+
+def test_orchestrate_dispatches_region_day_units(monkeypatch, queries):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "athena-events")
+    monkeypatch.setattr(
+        "common_utils.invoke_function",
+        lambda name, event: lambda_handler(event, None),
+    )
+    event = {"mode": "orchestrate", "from_day": "2024-03-01", "to_day": "2024-03-02"}
+    result = lambda_handler(event, None)
+    assert result["units"] == 6 and result["dispatched"] == 6
+    # Units with failed partitions (eu-central-1) run again
+    result = lambda_handler(event, None)
+    assert result["completed"] == 4 and result["dispatched"] == 2
+    assert result["run_id"] is None
+    # A forced run starts over, resuming it by its id skips the completed units
+    result = lambda_handler({**event, "force": True}, None)
+    assert result["run_id"] is not None and result["dispatched"] == 6
+    result = lambda_handler({**event, "force": True, "run_id": result["run_id"]}, None)
+    assert result["completed"] == 4 and result["dispatched"] == 2
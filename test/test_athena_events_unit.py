@@ -0,0 +1,89 @@
+import os
+
+from athena_events import (
+    TableType,
+    get_table_resource,
+    get_add_partitions_queries,
+    get_projection_properties,
+    normalize_query,
+    is_cacheable_query,
+    SortedRecords,
+)
+
+
+def test_table_resources(monkeypatch):
+    for table_type in TableType:
+        assert os.path.exists(get_table_resource(table_type))
+    assert get_table_resource(TableType.HISTORY).endswith("create_history_table.sql")
+    monkeypatch.setenv("HISTORY_FORMAT", "parquet")
+    assert get_table_resource(TableType.HISTORY).endswith(
+        "create_history_parquet_table.sql"
+    )
+
+
+def test_add_partitions_queries_are_chunked(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    days = [f"2024-03-{i:02d}" for i in range(1, 31)]
+    regions = ["us-east-1", "eu-west-1"]
+    queries = get_add_partitions_queries(TableType.HISTORY, days, regions)
+    assert len(queries) == 1
+    assert queries[0].count("PARTITION (") == 60
+
+    monkeypatch.setenv("MAX_QUERY_LENGTH", "2000")
+    queries = get_add_partitions_queries(TableType.CLOUD_TRAIL, days, regions)
+    assert len(queries) > 1
+    assert all(len(q) <= 2000 for q in queries)
+    assert sum(q.count("PARTITION (") for q in queries) == 60
+    assert all(q.startswith("ALTER TABLE default.cloud_trail ADD") for q in queries)
+    assert (
+        "LOCATION 's3://my-bucket/athena_audit/cloud_trail/eu-west-1/2024/03/30/'"
+        in (queries[-1])
+    )
+
+    # The limit is in bytes, multibyte values fill a statement sooner
+    queries = get_add_partitions_queries(TableType.HISTORY, days, ["é" * 200])
+    assert len(queries) > 1
+    assert all(len(q.encode("utf-8")) <= 2000 for q in queries)
+
+
+def test_projection_properties(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    monkeypatch.setenv("REGIONS", "us-east-1,eu-west-1")
+    properties = get_projection_properties(TableType.HISTORY)
+    assert properties["projection.region.values"] == "us-east-1,eu-west-1"
+    assert properties["projection.day.range"] == "2020-01-01,NOW"
+    assert (
+        properties["storage.location.template"]
+        == "s3://my-bucket/athena_audit/history/region=${region}/day=${day}"
+    )
+    properties = get_projection_properties(TableType.CLOUD_TRAIL)
+    assert properties["projection.month.digits"] == "2"
+    assert (
+        properties["storage.location.template"]
+        == "s3://my-bucket/athena_audit/cloud_trail/${region}/${year}/${month}/${day}/"
+    )
+
+
+def test_normalize_query():
+    assert normalize_query("  SELECT *\n FROM  t WHERE a = 'X  y' ;") == (
+        "select * from t where a = 'X  y'"
+    )
+    assert is_cacheable_query("(SELECT 1) UNION ALL (SELECT 2)")
+    assert is_cacheable_query("EXPLAIN (SELECT 1 FROM t LIMIT 1)")
+    assert is_cacheable_query("WITH a AS (SELECT 1) SELECT * FROM a")
+    assert not is_cacheable_query("INSERT INTO t SELECT 1")
+    assert not is_cacheable_query("ALTER TABLE t ADD PARTITION (day='1')")
+    assert not is_cacheable_query("DROP TABLE IF EXISTS t")
+
+
+def test_sorted_records_merge_spilled_runs(monkeypatch):
+    monkeypatch.setenv("LOCAL_JOIN_MAX_MEMORY_MB", "0.001")
+    records = SortedRecords(lambda r: (r["arn"] is None, r["arn"]))
+    arns = [f"arn-{i % 7}" for i in range(50)] + [None]
+    for i, arn in enumerate(arns):
+        records.add({"arn": arn, "i": i})
+    assert len(records.runs) > 1
+    assert [r["arn"] for r in records] == sorted(arns[:-1]) + [None]
+    records.close()
@@ -0,0 +1,144 @@
+import os
+from datetime import datetime, date, timedelta, timezone
+from typing import List
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from athena_history import (
+    create_history_days_range,
+    create_history_day_for_workgroup,
+    open_history_writer,
+)
+from benchmark_utils import (
+    get_benchmark_days,
+    get_benchmark_queries,
+    get_benchmark_workgroups,
+    run_benchmark,
+)
+from common_utils import create_client, get_day_back
+
+# Throughput of history collection with a synthetic stand-in for Athena
+
+
+class SyntheticAthena:
+    # Query executions of every workgroup, listed newest first and spread evenly over
+    # the benchmark days ending yesterday. Executions are generated from their id, so
+    # millions of them take no memory
+    def __init__(self, workgroups: List[str], queries: int, days: int):
+        self.workgroups = workgroups
+        self.queries = queries
+        today = datetime.combine(date.today(), datetime.min.time(), timezone.utc)
+        self.newest = today - timedelta(seconds=1)
+        self.step = timedelta(days=days) / queries
+
+    def list_work_groups(self) -> dict:
+        return {"WorkGroups": [{"Name": w} for w in self.workgroups]}
+
+    def get_paginator(self, operation_name: str):
+        return self
+
+    def paginate(self, WorkGroup: str):
+        # One page older than the benchmark days ends the listing
+        for start in range(0, self.queries + 50, 50):
+            yield {
+                "QueryExecutionIds": [
+                    f"{WorkGroup}/{i}" for i in range(start, start + 50)
+                ]
+            }
+
+    def get_query_executions(self, ids: List[str]) -> dict:
+        executions = []
+        for query_id in ids:
+            index = int(query_id.rsplit("/", 1)[1])
+            executions.append(
+                {
+                    "QueryExecutionId": query_id,
+                    "Query": f"SELECT * FROM events WHERE user_id = {index} LIMIT 10",
+                    "Status": {
+                        "State": "SUCCEEDED",
+                        "CompletionDateTime": self.newest - self.step * index,
+                    },
+                    "Statistics": {"DataScannedInBytes": index * 1024},
+                }
+            )
+        return {"QueryExecutions": executions}
+
+
+@pytest.fixture(autouse=True)
+def athena(monkeypatch):
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("TELEMETRY", "false")
+    synthetic = SyntheticAthena(
+        [f"workgroup-{i}" for i in range(get_benchmark_workgroups())],
+        get_benchmark_queries(),
+        get_benchmark_days(),
+    )
+    monkeypatch.setattr(
+        "athena_history.create_client",
+        lambda name, region_name=None: (
+            synthetic if name == "athena" else create_client(name, region_name)
+        ),
+    )
+    monkeypatch.setattr(
+        "athena_history.get_query_executions_data",
+        lambda athena, ids: athena.get_query_executions(ids),
+    )
+    mock = mock_aws()
+    mock.start()
+    boto3.client("s3").create_bucket(Bucket=os.environ["BUCKET"])
+    yield synthetic
+    mock.stop()
+
+
+@pytest.mark.parametrize("history_format", ["json", "parquet"])
+def test_benchmark_history_days_range(monkeypatch, history_format):
+    if history_format == "parquet":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setenv("HISTORY_FORMAT", history_format)
+    from_day = get_day_back(get_benchmark_days())
+    to_day = get_day_back(1)
+    result = run_benchmark(
+        f"history_days_range_{history_format}",
+        lambda: create_history_days_range(from_day, to_day)["records"],
+    )
+    assert result["records"] == get_benchmark_queries() * get_benchmark_workgroups()
+
+
+def test_benchmark_history_day_for_workgroup(athena):
+    from_day = get_day_back(get_benchmark_days())
+    to_day = get_day_back(1)
+    result = run_benchmark(
+        "history_day_for_workgroup",
+        lambda: create_history_day_for_workgroup(
+            from_day, to_day, athena.workgroups[0], athena
+        ),
+    )
+    assert result["records"] == get_benchmark_queries()
+
+
+def test_benchmark_history_upload(athena):
+    executions = athena.get_query_executions(
+        [f"upload/{i}" for i in range(get_benchmark_queries())]
+    )["QueryExecutions"]
+    records = [
+        {
+            "query_id": e["QueryExecutionId"],
+            "query": e["Query"],
+            "data_scanned": e["Statistics"]["DataScannedInBytes"],
+            "workgroup": "upload",
+        }
+        for e in executions
+    ]
+
+    def upload() -> int:
+        writer = open_history_writer(get_day_back(1), "upload")
+        for record in records:
+            writer.write(record)
+        writer.close()
+        return writer.rows
+
+    run_benchmark("history_upload", upload)
@@ -1,3 +1,5 @@
+import gzip
+import json
 import os
 from typing import List
 
@@ -5,8 +7,8 @@ import boto3.session
 import pytest
 from moto import mock_aws
 
-from athena_history import lambda_handler
-from common_utils import get_day_back
+from athena_history import lambda_handler, get_history_key
+from common_utils import create_client, get_day_back, reset_clients
 
 
 # This function is used to mock the response of the get_query_executions_data function since the
@@ -65,6 +67,38 @@ def test_validate_default_flow(monkeypatch):
     }
 
 
+def test_telemetry(monkeypatch, capsys):
+    monkeypatch.setenv("TELEMETRY", "true")
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    result = lambda_handler({"day": day, "force": True}, None)
+    telemetry = result["telemetry"]
+    assert telemetry["athena.ListQueryExecutions"]["calls"] >= 1
+    assert telemetry["athena.ListQueryExecutions"]["time_ms"] > 0
+    # The history file and its query id index
+    assert telemetry["s3.PutObject"]["calls"] == 2
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    emitted = {line["Operation"]: line for line in lines if "_aws" in line}
+    assert emitted["s3.PutObject"]["calls"] == 2
+
+
+def test_history_file_content(monkeypatch):
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    lambda_handler({"day": day, "workgroup": "primary", "force": True}, None)
+    s3 = boto3.client("s3")
+    body = s3.get_object(
+        Bucket=os.environ["BUCKET"], Key=get_history_key(day, "primary")
+    )
+    records = [
+        json.loads(line) for line in gzip.decompress(body["Body"].read()).splitlines()
+    ]
+    assert len(records) == 100
+    assert records[0]["workgroup"] == "primary"
+    assert records[0]["query"] == "SELECT 1"
+    assert {"query_id", "query", "data_scanned", "workgroup"} == set(records[0])
+
+
 def test_validate_default_flow_multiple_workgroups(monkeypatch):
     athena = boto3.client("athena")
     for i in range(10):
@@ -80,3 +114,170 @@ def test_validate_default_flow_multiple_workgroups(monkeypatch):
         "to_day": day,
         "workgroups": 11,
     }
+
+
+def test_workgroups_concurrency_limits(monkeypatch):
+    monkeypatch.setenv("WORKGROUP_WORKERS", "2")
+    monkeypatch.setenv("MAX_API_CALLS", "1")
+    athena = boto3.client("athena")
+    for i in range(3):
+        workgroup = f"workgroup-{i}"
+        athena.create_work_group(Name=workgroup, Configuration={})
+        _run_queries(workgroup, 100)
+    day = get_day_back(0)
+    result = lambda_handler({"day": day, "force": True}, None)
+    assert result["records"] == 300
+    assert result["workgroups"] == 4
+    result = lambda_handler({"day": day}, None)
+    assert result["records"] == 0
+    assert result["data-exists-workgroups"] == 3
+
+
+def test_throttled_batches_are_retried(monkeypatch):
+    from botocore.awsrequest import AWSResponse
+
+    monkeypatch.setenv("MAX_FETCH_WINDOW", "2")
+    throttled = []
+
+    class _Raw:
+        def stream(self):
+            yield b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'
+
+    def _throttle(**kwargs):
+        # Answers the first calls before they reach moto, the client retries them
+        if len(throttled) < 2:
+            throttled.append(kwargs["request"].url)
+            return AWSResponse(kwargs["request"].url, 400, {}, _Raw())
+
+    athena = create_client("athena")
+    athena.meta.events.register_first("before-send.athena.GetQueryExecution", _throttle)
+    try:
+        _run_queries("primary", 100)
+        day = get_day_back(0)
+        result = lambda_handler({"day": day, "force": True}, None)
+    finally:
+        # The throttled client keeps its lowered send rate, later tests get a new one
+        reset_clients()
+    assert len(throttled) == 2
+    assert result["records"] == 100
+
+
+def test_history_parquet_format(monkeypatch):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    import pyarrow
+
+    monkeypatch.setenv("HISTORY_FORMAT", "parquet")
+    monkeypatch.setenv("PARQUET_ROW_GROUP_SIZE", "40")
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    key = get_history_key(day, "primary")
+    assert key.endswith("/data.parquet")
+    result = lambda_handler({"day": day, "workgroup": "primary", "force": True}, None)
+    assert result["records"] == 100
+    s3 = boto3.client("s3")
+    body = s3.get_object(Bucket=os.environ["BUCKET"], Key=key)["Body"].read()
+    parquet_file = parquet.ParquetFile(pyarrow.BufferReader(body))
+    assert parquet_file.metadata.num_rows == 100
+    assert parquet_file.metadata.num_row_groups == 3
+    column = parquet_file.metadata.row_group(0).column(0)
+    assert column.compression == "ZSTD"
+    assert parquet_file.schema_arrow.names == [
+        "query_id",
+        "query",
+        "data_scanned",
+        "workgroup",
+    ]
+
+
+def test_incremental_collection(monkeypatch):
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    event = {"day": day, "workgroup": "primary", "incremental": True}
+    result = lambda_handler({**event, "force": True}, None)
+    assert result["records"] == 100
+    result = lambda_handler(event, None)
+    assert result["records"] == 0
+    s3 = boto3.client("s3")
+    keys = [
+        o["Key"] for o in s3.list_objects_v2(Bucket=os.environ["BUCKET"])["Contents"]
+    ]
+    assert len([k for k in keys if "/day=" in k and "/data" in k]) == 1
+    assert len([k for k in keys if k.endswith("/_query_ids.gz")]) == 1
+    assert any(
+        k.endswith("_watermarks/region=us-east-1/workgroup=primary.json") for k in keys
+    )
+
+
+def test_multiple_regions(monkeypatch):
+    monkeypatch.setenv("REGIONS", "us-east-1,eu-west-1")
+    _run_queries("primary", 100)
+    athena = boto3.client("athena", region_name="eu-west-1")
+    for _ in range(30):
+        athena.start_query_execution(
+            QueryString="SELECT 2",
+            ResultConfiguration={
+                "OutputLocation": f"s3://{os.environ["BUCKET"]}/temp/athena"
+            },
+            WorkGroup="primary",
+        )
+    day = get_day_back(0)
+    result = lambda_handler({"day": day, "force": True}, None)
+    assert result["records"] == 130
+    assert result["regions"]["us-east-1"]["records"] == 100
+    assert result["regions"]["eu-west-1"]["records"] == 30
+    body = boto3.client("s3").get_object(
+        Bucket=os.environ["BUCKET"],
+        Key=get_history_key(day, "primary", region="eu-west-1"),
+    )["Body"]
+    assert len(gzip.decompress(body.read()).splitlines()) == 30
+    result = lambda_handler({"day": day, "regions": "eu-west-1"}, None)
+    assert result["regions"]["eu-west-1"]["data-exists-workgroups"] == 1
+
+
+def test_append_only_missing_queries(monkeypatch):
+    monkeypatch.setenv("TELEMETRY", "true")
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    event = {"day": day, "workgroup": "primary"}
+    assert lambda_handler({**event, "force": True}, None)["records"] == 100
+    _run_queries("primary", 100)
+    result = lambda_handler({**event, "append": True}, None)
+    assert result["records"] == 100
+    assert result["telemetry"]["history.records"]["duplicates"] == 100
+    assert lambda_handler({**event, "append": True}, None)["records"] == 0
+    s3 = boto3.client("s3")
+    prefix = get_history_key(day, "primary").rsplit("/", 1)[0]
+    keys = [
+        o["Key"]
+        for o in s3.list_objects_v2(Bucket=os.environ["BUCKET"], Prefix=prefix)[
+            "Contents"
+        ]
+    ]
+    records = []
+    for key in keys:
+        if not key.endswith("/_query_ids.gz"):
+            body = s3.get_object(Bucket=os.environ["BUCKET"], Key=key)["Body"].read()
+            records += [json.loads(line) for line in gzip.decompress(body).splitlines()]
+    assert len(keys) == 3
+    assert len({r["query_id"] for r in records}) == len(records) == 200
+
+
+def test_running_executions_are_counted_as_dropped(monkeypatch):
+    running = []
+
+    def _running_query_executions_data(athena_client, ids: List[str]) -> dict:
+        result = _get_query_executions_data(athena_client, ids)
+        for query in result["QueryExecutions"]:
+            if len(running) < 10 and query["QueryExecutionId"] not in running:
+                running.append(query["QueryExecutionId"])
+                query["Status"] = {**query["Status"], "State": "RUNNING"}
+        return result
+
+    monkeypatch.setattr(
+        "athena_history.get_query_executions_data", _running_query_executions_data
+    )
+    _run_queries("primary", 100)
+    day = get_day_back(0)
+    result = lambda_handler({"day": day, "force": True}, None)
+    assert result["records"] == 90
+    assert result["dropped"] == 10
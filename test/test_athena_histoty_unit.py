@@ -1,6 +1,14 @@
+from datetime import datetime, timezone
+
 import pytest
 
-from athena_history import lambda_handler, get_location
+from athena_history import (
+    lambda_handler,
+    get_location,
+    Watermark,
+    DayWriters,
+    is_before_margin,
+)
 
 
 def test_validate_day_range():
@@ -17,3 +25,87 @@ def test_get_location():
 def test_get_location_env_var(monkeypatch):
     monkeypatch.setenv("FOLDER", "my_location/")
     assert get_location() == "my_location"
+
+
+def _query(query_id: str, state: str = "SUCCEEDED") -> dict:
+    status = {"State": state}
+    if state != "RUNNING":
+        status["CompletionDateTime"] = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return {"QueryExecutionId": query_id, "Status": status}
+
+
+def test_watermark_moves_to_newest_collected():
+    watermark = Watermark("q0")
+    for query_id in ["q3", "q2", "q1"]:
+        watermark.observe(_query(query_id), collected=True)
+    assert watermark.next()["query_execution_id"] == "q3"
+    assert watermark.next()["collected_ids"] == []
+
+
+def test_watermark_held_back_by_running_queries():
+    watermark = Watermark("q0")
+    watermark.observe(_query("q4"), collected=True)
+    watermark.observe(_query("q3", "RUNNING"), collected=False)
+    watermark.observe(_query("q2"), collected=True)
+    watermark.observe(_query("q1"), collected=True)
+    assert watermark.next() == {
+        "query_execution_id": "q2",
+        "completion_date_time": "2024-01-01T00:00:00+00:00",
+        "collected_ids": ["q4"],
+    }
+    watermark = Watermark("q0", collected_ids=["q5"])
+    watermark.observe(_query("q2"), collected=True)
+    watermark.observe(_query("q1", "RUNNING"), collected=False)
+    assert watermark.next()["query_execution_id"] == "q0"
+    assert set(watermark.next()["collected_ids"]) == {"q2", "q5"}
+
+
+def test_is_before_margin(monkeypatch):
+    monkeypatch.setenv("LATE_MARGIN_MINUTES", "30")
+    query = _query("q1")
+    query["Status"]["SubmissionDateTime"] = datetime(
+        2023, 12, 31, 23, 45, tzinfo=timezone.utc
+    )
+    assert not is_before_margin(query, "2024-01-01")
+    query["Status"]["SubmissionDateTime"] = datetime(
+        2023, 12, 31, 23, 15, tzinfo=timezone.utc
+    )
+    assert is_before_margin(query, "2024-01-01")
+
+
+class _Writer:
+    opened = []
+
+    def __init__(self, day, workgroup, s3_client=None, part=None, region=None):
+        self.rows = 0
+        _Writer.opened.append((day, part))
+
+    def write(self, record):
+        self.rows += 1
+
+    def close(self):
+        pass
+
+
+def test_day_writers_out_of_order(monkeypatch):
+    monkeypatch.setenv("MAX_OPEN_DAYS", "2")
+    monkeypatch.setattr("athena_history.open_history_writer", _Writer)
+    monkeypatch.setattr("athena_history.load_query_ids", lambda *args: set())
+    monkeypatch.setattr("athena_history.save_query_ids", lambda *args: None)
+    _Writer.opened = []
+    writers = DayWriters("primary", object())
+    days = ["2024-01-03", "2024-01-02", "2024-01-03", "2024-01-01", "2024-01-03"]
+    for i, day in enumerate(days):
+        writers.write(day, {"query_id": f"q{i}"})
+    writers.write("2024-01-01", {"query_id": "q3"})
+    writers.close()
+    assert writers.rows == 5
+    # 2024-01-03 was closed to open 2024-01-01, its last record is late
+    assert writers.late == 1
+    assert writers.duplicates == 1
+    assert _Writer.opened == [
+        ("2024-01-03", None),
+        ("2024-01-02", None),
+        ("2024-01-01", None),
+        ("2024-01-03", "late-1"),
+    ]
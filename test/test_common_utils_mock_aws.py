@@ -0,0 +1,153 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from common_utils import (
+    S3MultipartWriter,
+    iter_s3_lines,
+    clear_folder,
+    list_keys,
+    complete_unit,
+    fan_out,
+    claim_unit,
+    get_run_prefix,
+)
+
+
+@pytest.fixture(autouse=True)
+def s3_mock(monkeypatch):
+    monkeypatch.setenv("BUCKET", "my-bucket")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    mock = mock_aws()
+    mock.start()
+    boto3.client("s3").create_bucket(Bucket=os.environ["BUCKET"])
+    yield
+    mock.stop()
+
+
+def _read(key: str) -> bytes:
+    s3 = boto3.client("s3")
+    return s3.get_object(Bucket=os.environ["BUCKET"], Key=key)["Body"].read()
+
+
+def test_multipart_writer_small_object():
+    with S3MultipartWriter(os.environ["BUCKET"], "small/data") as writer:
+        writer.write(b"hello ")
+        writer.write(b"world")
+    assert _read("small/data") == b"hello world"
+
+
+def test_multipart_writer_uploads_parts():
+    chunk = os.urandom(1024 * 1024)
+    part_size = 5 * 1024 * 1024
+    with S3MultipartWriter(os.environ["BUCKET"], "big/data", part_size=part_size) as w:
+        for _ in range(12):
+            w.write(chunk)
+        assert len(w._parts) == 2
+        assert w.tell() == 12 * len(chunk)
+    assert _read("big/data") == chunk * 12
+
+
+def test_multipart_writer_abort():
+    part_size = 5 * 1024 * 1024
+    with pytest.raises(ValueError):
+        with S3MultipartWriter(
+            os.environ["BUCKET"], "aborted", part_size=part_size
+        ) as w:
+            w.write(os.urandom(part_size))
+            raise ValueError("failed")
+    s3 = boto3.client("s3")
+    assert s3.list_objects_v2(Bucket=os.environ["BUCKET"])["KeyCount"] == 0
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=os.environ["BUCKET"])
+
+
+def test_iter_s3_lines_ranged_reads():
+    content = "".join(f"line {i} ünïcødé\n" for i in range(1000)) + "last"
+    boto3.client("s3").put_object(
+        Bucket=os.environ["BUCKET"], Key="lines.txt", Body=content.encode("utf-8")
+    )
+    lines = list(iter_s3_lines(os.environ["BUCKET"], "lines.txt", chunk_size=1000))
+    assert len(lines) == 1001
+    assert "".join(lines) == content
+
+
+def test_iter_s3_lines_empty_object():
+    boto3.client("s3").put_object(Bucket=os.environ["BUCKET"], Key="empty", Body=b"")
+    assert list(iter_s3_lines(os.environ["BUCKET"], "empty")) == []
+
+
+def test_clear_folder_deletes_all_batches(monkeypatch):
+    monkeypatch.setenv("S3_DELETE_WORKERS", "3")
+    s3 = boto3.client("s3")
+    for i in range(2500):
+        s3.put_object(Bucket=os.environ["BUCKET"], Key=f"folder/{i}", Body=b"")
+    s3.put_object(Bucket=os.environ["BUCKET"], Key="other/1", Body=b"")
+    assert list_keys(os.environ["BUCKET"], "folder/") == {
+        f"folder/{i}" for i in range(2500)
+    }
+    assert clear_folder(os.environ["BUCKET"], "folder/") == 2500
+    assert list_keys(os.environ["BUCKET"], "") == {"other/1"}
+
+
+def test_fan_out_resumes_incomplete_units(monkeypatch):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "athena-history")
+    invoked = []
+
+    def _handler(event: dict):
+        invoked.append(event["day"])
+        if event["day"] != "2024-03-02" or len(invoked) > 3:
+            complete_unit(event, {"day": event["day"]})
+
+    monkeypatch.setattr(
+        "common_utils.invoke_function", lambda name, event: _handler(event)
+    )
+    units = [{"day": day} for day in ["2024-03-01", "2024-03-02", "2024-03-03"]]
+    prefix = get_run_prefix("orchestrations", units)
+    result = fan_out(None, units, os.environ["BUCKET"], prefix)
+    assert result["dispatched"] == 3
+    # The incomplete unit may still be running, it is not dispatched twice
+    result = fan_out(None, units, os.environ["BUCKET"], prefix)
+    assert result["completed"] == 2 and result["in_progress"] == 1
+    assert result["dispatched"] == 0
+    # Once it was dispatched long enough ago it is dispatched again
+    monkeypatch.setenv("FAN_OUT_DISPATCH_TIMEOUT_MINUTES", "0")
+    result = fan_out(None, units, os.environ["BUCKET"], prefix)
+    assert result["completed"] == 2 and result["dispatched"] == 1
+    assert invoked[3:] == ["2024-03-02"]
+    result = fan_out(None, units, os.environ["BUCKET"], prefix)
+    assert result["completed"] == 3 and result["dispatched"] == 0
+
+
+def test_fan_out_caps_running_units(monkeypatch):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "athena-history")
+    monkeypatch.setenv("FAN_OUT_WORKERS", "2")
+    invoked = []
+    monkeypatch.setattr(
+        "common_utils.invoke_function", lambda name, event: invoked.append(event)
+    )
+    units = [{"day": f"2024-03-0{i}"} for i in range(1, 6)]
+    prefix = get_run_prefix("orchestrations", units)
+    resume = {"mode": "orchestrate"}
+    result = fan_out(None, units, os.environ["BUCKET"], prefix, resume)
+    assert result["dispatched"] == 2 and result["queued"] == 3
+    assert all(e["orchestration"]["resume"] == resume for e in invoked)
+    result = fan_out(None, units, os.environ["BUCKET"], prefix, resume)
+    assert result["in_progress"] == 2 and result["dispatched"] == 0
+    # A completed unit resumes the orchestration, which dispatches the next unit
+    complete_unit(invoked[0], {})
+    assert invoked[-1] == resume
+    result = fan_out(None, units, os.environ["BUCKET"], prefix, resume)
+    assert result["completed"] == 1 and result["in_progress"] == 1
+    assert result["dispatched"] == 1 and result["queued"] == 2
+
+
+def test_claim_unit_once():
+    s3 = boto3.client("s3")
+    unit = {"day": "2024-03-01"}
+    assert claim_unit(s3, os.environ["BUCKET"], "dispatched/1.json", unit, None)
+    assert not claim_unit(s3, os.environ["BUCKET"], "dispatched/1.json", unit, None)
+    expired = s3.list_objects_v2(Bucket=os.environ["BUCKET"])["Contents"][0]
+    assert claim_unit(s3, os.environ["BUCKET"], "dispatched/1.json", unit, expired)
+    assert not claim_unit(s3, os.environ["BUCKET"], "dispatched/1.json", unit, expired)
@@ -0,0 +1,66 @@
+import concurrent.futures
+import json
+
+from common_utils import AdaptiveWindow, Metrics, create_client, reset_clients
+
+
+def test_adaptive_window_grows_on_stable_latency():
+    window = AdaptiveWindow(max_size=5, initial_size=2)
+    for _ in range(10):
+        window.on_success(0.1)
+    assert window.size == 5
+
+
+def test_adaptive_window_shrinks_on_throttle_and_slow_calls():
+    window = AdaptiveWindow(max_size=8, initial_size=8)
+    window.on_throttle()
+    assert window.size == 4
+    window.on_success(0.1)
+    window.on_success(1.0)
+    assert window.size == 3
+    for _ in range(5):
+        window.on_throttle()
+    assert window.size == 1
+
+
+def test_create_client_is_shared_per_service_and_region(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    monkeypatch.setenv("MAX_POOL_CONNECTIONS", "7")
+    reset_clients()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(lambda _: create_client("s3"), range(32)))
+    assert all(c is clients[0] for c in clients)
+    assert clients[0].meta.region_name == "eu-west-1"
+    assert clients[0].meta.config.max_pool_connections == 7
+    assert clients[0].meta.config.retries["mode"] == "adaptive"
+    assert create_client("s3", "us-east-1") is not clients[0]
+    reset_clients()
+    assert create_client("s3") is not clients[0]
+
+
+def test_metrics_summary_and_embedded_metric_format(monkeypatch, capsys):
+    monkeypatch.setenv("TELEMETRY", "true")
+    metrics = Metrics()
+    metrics.record("athena.query", wall_ms=30, scanned_bytes=100)
+    metrics.record("athena.query", wall_ms=10, scanned_bytes=50)
+    metrics.record("athena.query", calls=0, throttles=1)
+    assert metrics.summary() == {
+        "athena.query": {
+            "calls": 2,
+            "wall_ms": 40,
+            "max_wall_ms": 30,
+            "scanned_bytes": 150,
+            "throttles": 1,
+        }
+    }
+    metrics.emit("athena_events")
+    line = json.loads(capsys.readouterr().out)
+    assert line["Operation"] == "athena.query"
+    assert line["max_wall_ms"] == 30
+    units = {
+        m["Name"]: m["Unit"] for m in line["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    }
+    assert units["wall_ms"] == "Milliseconds"
+    assert units["scanned_bytes"] == "Bytes"
+    metrics.reset()
+    assert metrics.summary() == {}